@@ -0,0 +1,159 @@
+"""Dynamic batching of concurrent OCR requests into single engine calls."""
+
+import asyncio
+import logging
+from concurrent.futures import Executor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class DynamicBatcher:
+    """
+    Collect concurrent OCR requests and run them through one batched call.
+
+    Requests are queued; a background task takes the first waiting request,
+    keeps collecting for up to ``max_wait`` seconds (or until
+    ``max_batch_size`` requests are waiting), groups them by language and
+    hands each group to ``batch_fn(images, language)`` on ``executor``
+    (the default thread pool when None). ``batch_fn`` must return one
+    result per image, in order.
+
+    With ``prepare_fn`` the work is split into a two-stage pipeline:
+    ``prepare_fn(images, language)`` runs on ``prepare_executor`` (CPU
+    preprocessing) and its return value is passed to
+    ``batch_fn(prepared, language)`` on ``executor``. Up to
+    ``pipeline_depth`` prepared batches wait between the stages, so the
+    next batch is preprocessed while the current one generates.
+    """
+
+    def __init__(self, batch_fn: Callable[[Any, str], List[Dict[str, Any]]],
+                 max_batch_size: int = 16, max_wait: float = 0.01,
+                 executor: Optional[Executor] = None,
+                 prepare_fn: Optional[Callable[[List[Any], str], Any]] = None,
+                 prepare_executor: Optional[Executor] = None,
+                 pipeline_depth: int = 1):
+        self.batch_fn = batch_fn
+        self.executor = executor
+        self.prepare_fn = prepare_fn
+        self.prepare_executor = prepare_executor
+        self.pipeline_depth = pipeline_depth
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start the background batching task on the running event loop."""
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the background batching task."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def submit(self, image: Any, language: str) -> Dict[str, Any]:
+        """Queue one image and wait for its OCR result."""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((image, language, future))
+        return await future
+
+    async def _collect(self) -> List[Tuple[Any, str, asyncio.Future]]:
+        """Wait for one request, then gather more until the batch window closes."""
+        loop = asyncio.get_running_loop()
+        items = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+
+        while len(items) < self.max_batch_size:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+
+        return items
+
+    async def _run(self):
+        """Preparation stage: collect, group by language, prepare, hand over to the generate stage."""
+        loop = asyncio.get_running_loop()
+        prepared: asyncio.Queue = asyncio.Queue(maxsize=self.pipeline_depth)
+        generator = asyncio.create_task(self._generate(prepared))
+
+        try:
+            while True:
+                items = await self._collect()
+
+                groups: Dict[str, List[Tuple[Any, str, asyncio.Future]]] = {}
+                for item in items:
+                    groups.setdefault(item[1], []).append(item)
+
+                for language, group in groups.items():
+                    # Skip requests whose callers have already given up
+                    group = [item for item in group if not item[2].done()]
+                    if not group:
+                        continue
+
+                    images = [item[0] for item in group]
+                    if self.prepare_fn is None:
+                        payload = images
+                    else:
+                        try:
+                            payload = await loop.run_in_executor(
+                                self.prepare_executor, self.prepare_fn, images, language
+                            )
+                        except Exception as e:
+                            logger.error(f"OCR batch preparation failed: {e}")
+                            self._fail(group, e)
+                            continue
+
+                    # Blocks while the generate stage is pipeline_depth batches behind
+                    await prepared.put((language, group, payload))
+        finally:
+            generator.cancel()
+
+    async def _generate(self, prepared: asyncio.Queue):
+        """Generate stage: run batch_fn on each prepared batch and resolve futures."""
+        loop = asyncio.get_running_loop()
+        while True:
+            language, group, payload = await prepared.get()
+            if all(future.done() for _, _, future in group):
+                continue
+
+            logger.info(f"Running OCR batch of {len(group)} ({language})")
+            try:
+                results = await loop.run_in_executor(self.executor, self.batch_fn, payload, language)
+            except Exception as e:
+                logger.error(f"OCR batch failed: {e}")
+                self._fail(group, e)
+                continue
+
+            returned = len(results) if results is not None else 0
+            if returned != len(group):
+                # zip() would silently leave the unmatched callers waiting forever
+                message = f"OCR batch returned {returned} results for {len(group)} images"
+                logger.error(message)
+                self._fail(group, RuntimeError(message))
+                continue
+
+            for (_, _, future), result in zip(group, results):
+                if not future.done():
+                    future.set_result(result)
+
+    @staticmethod
+    def _fail(group: List[Tuple[Any, str, asyncio.Future]], error: Exception):
+        """Propagate a batch-level error to every caller still waiting."""
+        for _, _, future in group:
+            if not future.done():
+                future.set_exception(error)
@@ -0,0 +1,349 @@
+"""Generation helpers (device choice, stopping criteria, compilation, CPU precision) shared by the Qwen2.5-VL engines."""
+
+import importlib.util
+import logging
+import platform
+import sys
+import time
+from typing import Optional, Union
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+try:
+    import torch
+    from transformers import StoppingCriteria, TextStreamer
+    TRANSFORMERS_AVAILABLE = True
+except ImportError:
+    TRANSFORMERS_AVAILABLE = False
+    StoppingCriteria = TextStreamer = object
+
+# FlashAttention-2 kernels (CUDA, fp16/bf16 only); checked without importing the extension
+FLASH_ATTN_AVAILABLE = importlib.util.find_spec("flash_attn") is not None
+
+# bitsandbytes 4-bit weights (CUDA only); checked without importing the extension
+BITSANDBYTES_AVAILABLE = importlib.util.find_spec("bitsandbytes") is not None
+
+# Intel Extension for PyTorch: AMX/AVX-512 bf16 kernels on x86 servers (imported only when used)
+IPEX_AVAILABLE = importlib.util.find_spec("intel_extension_for_pytorch") is not None
+
+# optimum-quanto int8 weights, which (unlike dynamic quantization) also run on MPS
+QUANTO_AVAILABLE = (importlib.util.find_spec("optimum") is not None
+                    and importlib.util.find_spec("optimum.quanto") is not None)
+
+# Weight formats the CPU engines accept for their quantization option
+CPU_QUANTIZATIONS = ("fp32", "bf16", "int8")
+
+# Set once a model fails its MPS probe, so later loads go straight to CPU
+_mps_broken = False
+
+
+def pick_device() -> str:
+    """Fastest available torch device: CUDA, then Apple Silicon's MPS, then CPU."""
+    if torch.cuda.is_available():
+        return "cuda"
+    if not _mps_broken and hasattr(torch.backends, "mps") and torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+def accelerator_dtype(device: str) -> "torch.dtype":
+    """Half-precision weight dtype for a GPU device (MPS has no native bf16)."""
+    if device == "cuda" and torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    return torch.float16
+
+
+def attn_implementation(device: str, torch_dtype) -> str:
+    """
+    Fused attention for the vision and text towers.
+
+    FlashAttention-2 on Ampere or newer CUDA GPUs with half-precision
+    weights, PyTorch's SDPA (CPU, MPS and older CUDA) otherwise; both
+    avoid materialising the full attention matrix that the eager path builds.
+    """
+    if (device == "cuda" and FLASH_ATTN_AVAILABLE
+            and torch_dtype in (torch.float16, torch.bfloat16)
+            and torch.cuda.get_device_capability() >= (8, 0)):
+        return "flash_attention_2"
+    return "sdpa"
+
+
+def nf4_load_kwargs() -> dict:
+    """
+    from_pretrained() kwargs for NF4 4-bit weights on CUDA (needs bitsandbytes).
+
+    The decoder streams every weight once per token, so a quarter of the
+    bytes means faster decoding; double quantization also packs the scales.
+    """
+    from transformers import BitsAndBytesConfig
+    return {
+        "quantization_config": BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=accelerator_dtype("cuda"),
+            bnb_4bit_use_double_quant=True
+        ),
+        "device_map": "auto"
+    }
+
+
+def empty_device_cache(device: str):
+    """Release cached allocator blocks on the model's device."""
+    if device == "cuda":
+        torch.cuda.empty_cache()
+    elif device == "mps":
+        torch.mps.empty_cache()
+
+
+def is_out_of_memory(error: BaseException) -> bool:
+    """Whether an exception means host or device memory ran out."""
+    if isinstance(error, MemoryError) or type(error).__name__ == "OutOfMemoryError":
+        return True
+    return "out of memory" in str(error).lower()
+
+
+def probe_mps(model, device: str, probe) -> tuple:
+    """
+    Check a freshly loaded model actually runs on MPS and return (model, device).
+
+    probe() runs one tiny inference. Ops MPS doesn't implement fail here rather
+    than on a request; the model then moves to CPU in float32 and pick_device()
+    stops offering MPS for the rest of the process.
+    """
+    global _mps_broken
+    if device != "mps":
+        return model, device
+    try:
+        with torch.inference_mode():
+            probe()
+        logger.info("MPS probe passed")
+        return model, device
+    except Exception as e:
+        logger.warning(f"MPS probe failed ({e}), falling back to CPU")
+        _mps_broken = True
+        return model.to("cpu", dtype=torch.float32), "cpu"
+
+
+def default_cpu_quantization() -> str:
+    """bf16 on CPUs that run it natively (Apple Silicon, x86 with AVX512-BF16/AMX); fp32 elsewhere."""
+    if sys.platform == "darwin" and platform.machine() == "arm64":
+        return "bf16"
+    # Private torch helper; absent on some builds, in which case fp32 is kept
+    if TRANSFORMERS_AVAILABLE and getattr(torch.cpu, "_is_avx512_bf16_supported", lambda: False)():
+        return "bf16"
+    return "fp32"
+
+
+def cpu_torch_dtype(quantization: str) -> "torch.dtype":
+    """dtype to load weights in for a CPU quantization setting (int8 quantizes after an fp32 load)."""
+    return torch.bfloat16 if quantization == "bf16" else torch.float32
+
+
+def optimize_for_cpu(model, quantization: str):
+    """
+    Apply a CPU weight format to a loaded model and return the model to use.
+
+    bf16 halves the weight bytes the memory-bound decoder streams per token and
+    goes through IPEX on x86 when it is installed; int8 uses dynamic
+    quantization of every nn.Linear (int8 weights, activations quantized
+    on the fly).
+    """
+    if quantization == "bf16" and IPEX_AVAILABLE:
+        import intel_extension_for_pytorch as ipex
+        model = ipex.optimize(model.eval(), dtype=torch.bfloat16, inplace=True)
+        logger.info("IPEX bf16 optimization applied")
+    elif quantization == "int8":
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        logger.info("Dynamic int8 quantization applied to Linear layers")
+    return model
+
+
+def quantize_int8_weights(model):
+    """
+    Store a loaded model's Linear weights as int8 with optimum-quanto and return it.
+
+    Quarters the weight bytes streamed per decoded token on devices dynamic
+    quantization doesn't support (MPS); activations stay in the model's dtype.
+    """
+    from optimum.quanto import freeze, qint8, quantize
+    quantize(model, weights=qint8)
+    freeze(model)
+    logger.info("quanto int8 weight quantization applied")
+    return model
+
+
+def compile_setting(value: str):
+    """
+    Parse QWEN_TORCH_COMPILE: "0"/"" -> False, "1" -> True (mode picked per
+    device), anything else is a torch.compile mode name such as "max-autotune".
+    """
+    if value in ("", "0"):
+        return False
+    return True if value == "1" else value
+
+
+def compile_forward(model, device: str, mode: Union[bool, str, None] = None,
+                    dynamic: Optional[bool] = True) -> str:
+    """
+    torch.compile a model's forward in place and return the mode used.
+
+    Only forward is compiled: generate() stays eager and calls it once per
+    step. dynamic=True keeps varying image-token counts from triggering a
+    recompile per image size; callers whose image shapes are fixed pass
+    None, so torch specializes first and only goes dynamic if shapes do
+    change. mode is a torch.compile mode name (e.g. a compile_setting()
+    result); when it is not a string, CUDA graphs ("reduce-overhead") are
+    used on CUDA and the default mode elsewhere.
+    """
+    if not isinstance(mode, str):
+        mode = "reduce-overhead" if device == "cuda" else "default"
+    model.forward = torch.compile(model.forward, mode=mode, fullgraph=False, dynamic=dynamic)
+    logger.info(f"torch.compile enabled (mode={mode})")
+    return mode
+
+
+class StopOnBlankLine(StoppingCriteria):
+    """
+    Finish a sequence once it has produced a blank line ("\\n\\n").
+
+    Works per row, so in a batch only the sequences that reached a blank
+    line stop. Only the last few generated tokens are decoded each step.
+    """
+
+    def __init__(self, tokenizer, prompt_length: int, lookback: int = 3):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.lookback = lookback
+
+    def __call__(self, input_ids: "torch.LongTensor", scores: "torch.FloatTensor", **kwargs) -> "torch.BoolTensor":
+        generated = input_ids[:, self.prompt_length:]
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        if generated.shape[1] == 0:
+            return done
+        tails = self.tokenizer.batch_decode(generated[:, -self.lookback:], skip_special_tokens=True)
+        for row, tail in enumerate(tails):
+            # Ignore blank lines before any text has been produced
+            if "\n\n" in tail.lstrip("\n"):
+                done[row] = True
+        return done
+
+
+class StopOnRepeat(StoppingCriteria):
+    """
+    Finish a sequence once it is stuck in a loop.
+
+    A row stops when its last generated tokens are one block of
+    min_period..max_period tokens repeated `repeats` times in a row.
+    Shorter periods never count: digits are single tokens and OCR text
+    legitimately contains "1000", "...", "---" or "| | |", so a tail whose
+    true period is below min_period is left alone. Nothing is checked
+    before min_new_tokens tokens exist. Works per row and stays on the
+    device (no decoding, no host sync).
+    """
+
+    def __init__(self, prompt_length: int, min_period: int = 4, max_period: int = 16,
+                 repeats: int = 4, min_new_tokens: int = 32):
+        self.prompt_length = prompt_length
+        self.min_period = min_period
+        self.max_period = max_period
+        self.repeats = repeats
+        self.min_new_tokens = min_new_tokens
+
+    def __call__(self, input_ids: "torch.LongTensor", scores: "torch.FloatTensor", **kwargs) -> "torch.BoolTensor":
+        generated = input_ids[:, self.prompt_length:]
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        if generated.shape[1] < self.min_new_tokens:
+            return done
+        for period in range(self.min_period, self.max_period + 1):
+            span = period * self.repeats
+            if generated.shape[1] < span:
+                break
+            tail = generated[:, -span:]
+            looping = (tail[:, period:] == tail[:, :-period]).all(dim=1)
+            # A run with a shorter true period (e.g. "0000..." or "| | |") is text, not a loop
+            for short_period in range(1, self.min_period):
+                looping &= ~(tail[:, short_period:] == tail[:, :-short_period]).all(dim=1)
+            done |= looping
+        return done
+
+
+class DeadlineStoppingCriteria(StoppingCriteria):
+    """
+    Stop the whole batch once a wall-clock budget is spent.
+
+    Checked between decoding steps, so generate() returns cleanly with the
+    tokens produced so far instead of running on unobserved. expired tells
+    the caller whether the budget (rather than EOS or max_new_tokens)
+    ended generation.
+    """
+
+    def __init__(self, budget: float, start: float = None):
+        self.deadline = (time.monotonic() if start is None else start) + budget
+        self.expired = False
+
+    def __call__(self, input_ids: "torch.LongTensor", scores: "torch.FloatTensor", **kwargs) -> "torch.BoolTensor":
+        if time.monotonic() >= self.deadline:
+            self.expired = True
+        return torch.full((input_ids.shape[0],), self.expired, dtype=torch.bool, device=input_ids.device)
+
+
+class TokenProgress(StoppingCriteria):
+    """
+    Report generation progress through a progress callback; never stops generation.
+
+    Called once per decoding step; every `every` new tokens it reports a
+    percentage between `start` and `end`, scaled by max_new_tokens.
+    """
+
+    def __init__(self, progress_callback, prompt_length: int, max_new_tokens: int,
+                 start: int = 90, end: int = 99, every: int = 16):
+        self.progress_callback = progress_callback
+        self.prompt_length = prompt_length
+        self.max_new_tokens = max_new_tokens
+        self.start = start
+        self.end = end
+        self.every = every
+
+    def __call__(self, input_ids: "torch.LongTensor", scores: "torch.FloatTensor", **kwargs) -> "torch.BoolTensor":
+        generated = input_ids.shape[1] - self.prompt_length
+        if generated and generated % self.every == 0:
+            fraction = min(generated / self.max_new_tokens, 1.0)
+            self.progress_callback(
+                f"Generated {generated} tokens...", round(self.start + (self.end - self.start) * fraction)
+            )
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+
+class TextProgress(TextStreamer):
+    """
+    Stream the text decoded so far through a progress callback while generate() runs.
+
+    Passed as generate(streamer=...), so it runs on the generating thread and
+    needs no extra thread; batch size 1 only. The callback receives the
+    partial text and a percentage between `start` and `end`, scaled by
+    max_new_tokens. Text is flushed at word boundaries.
+    """
+
+    def __init__(self, tokenizer, progress_callback, max_new_tokens: int, start: int = 80, end: int = 99):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.progress_callback = progress_callback
+        self.max_new_tokens = max_new_tokens
+        self.start = start
+        self.end = end
+        self.generated = 0
+        self.text = ""
+
+    def put(self, value):
+        # The first put() is the prompt, which skip_prompt drops
+        if not self.next_tokens_are_prompt:
+            self.generated += 1
+        super().put(value)
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        if not text:
+            return
+        self.text += text
+        fraction = min(self.generated / self.max_new_tokens, 1.0)
+        self.progress_callback(self.text.strip(), round(self.start + (self.end - self.start) * fraction))
@@ -0,0 +1,237 @@
+"""Image loading helpers shared by the OCR engines."""
+
+import io
+import logging
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# libjpeg-turbo decodes JPEGs straight to an RGB array, skipping PIL
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _turbo_jpeg = TurboJPEG()
+    TURBOJPEG_AVAILABLE = True
+except Exception:
+    # ImportError, or the shared library itself is missing
+    TURBOJPEG_AVAILABLE = False
+
+# libvips shrink-on-load + SIMD Lanczos for decode-and-downscale in one pass
+try:
+    import pyvips
+    PYVIPS_AVAILABLE = True
+except Exception:
+    # ImportError, or libvips itself is missing
+    PYVIPS_AVAILABLE = False
+
+# Anything an engine's extract_text() accepts as its image argument
+# (numpy arrays are decoded RGB uint8, as produced by decode_image)
+ImageSource = Union[str, Path, bytes, bytearray, Image.Image, np.ndarray]
+
+# Longest side images are scaled down to before OCR (Qwen's working size)
+MAX_IMAGE_SIDE = 1024
+
+# Bytes needed to classify an upload with sniff_mime()
+SNIFF_BYTES = 12
+
+# (offset, signature, mime type) for every format the server accepts
+_MAGIC_SIGNATURES = (
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"II*\x00", "image/tiff"),
+    (0, b"MM\x00*", "image/tiff"),
+    (8, b"WEBP", "image/webp"),
+    (0, b"%PDF-", "application/pdf"),
+)
+
+
+def open_image(source: ImageSource) -> Image.Image:
+    """
+    Open an OCR input as a PIL image.
+
+    Raw bytes are decoded straight from memory and PIL images are passed
+    through, so uploads never need to be written to disk first.
+
+    Args:
+        source: File path, raw encoded image bytes or an already-open PIL image
+
+    Returns:
+        PIL image (not yet converted to RGB)
+    """
+    if isinstance(source, Image.Image):
+        return source
+    if isinstance(source, np.ndarray):
+        return Image.fromarray(source)
+    if isinstance(source, (bytes, bytearray)):
+        return Image.open(io.BytesIO(source))
+    return Image.open(source)
+
+
+def ensure_rgb(image: Image.Image) -> Image.Image:
+    """Convert to RGB, skipping the full-image copy convert() makes when it already is."""
+    return image if image.mode == "RGB" else image.convert("RGB")
+
+
+def decode_image(source: ImageSource, max_side: Optional[int] = MAX_IMAGE_SIDE) -> np.ndarray:
+    """
+    Decode an upload once into an RGB array that every engine can share.
+
+    JPEGs are decoded at 1/2, 1/4 or 1/8 scale straight from the DCT
+    coefficients (PIL's draft mode) when that still leaves the longest side
+    at least max_side, then the image is downscaled (keeping its
+    aspect ratio) so its longest side is at most max_side.
+
+    Args:
+        source: File path, raw encoded image bytes or PIL image
+        max_side: Longest side of the result, or None to keep full size
+
+    Returns:
+        RGB uint8 array of shape (height, width, 3)
+    """
+    if PYVIPS_AVAILABLE and max_side and isinstance(source, (str, Path, bytes, bytearray)):
+        try:
+            return _vips_thumbnail(source, max_side)
+        except Exception:
+            pass  # Formats libvips can't load go through PIL
+
+    image = open_image(source)
+    if max_side:
+        if image.format == "JPEG":
+            _draft_jpeg(image, max_side)
+        # thumbnail() resizes in place, so a caller's PIL image must still be copied
+        image = image.convert("RGB") if image is source else ensure_rgb(image)
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+    else:
+        image = ensure_rgb(image)
+    return np.asarray(image)
+
+
+def _draft_jpeg(image: Image.Image, max_side: int):
+    """
+    Ask libjpeg for the smallest 1/2**k decode whose longest side is still >= max_side.
+
+    draft() picks its scale from the requested box, so the box is the
+    aspect-preserving target size rather than a max_side square (which a
+    long, narrow page would never shrink to).
+    """
+    width, height = image.size
+    scale = max_side / max(width, height)
+    if scale >= 0.5:
+        return  # No power-of-two reduction keeps the longest side >= max_side
+    target = (max(1, round(width * scale)), max(1, round(height * scale)))
+    image.draft("RGB", target)
+    logger.debug(f"JPEG draft {width}x{height} -> {image.mode} {image.size[0]}x{image.size[1]}")
+
+
+def _vips_thumbnail(source: Union[str, Path, bytes, bytearray], max_side: int) -> np.ndarray:
+    """Decode straight to an RGB array no larger than max_side with libvips."""
+    if isinstance(source, (bytes, bytearray)):
+        image = pyvips.Image.thumbnail_buffer(bytes(source), max_side, size="down")
+    else:
+        image = pyvips.Image.thumbnail(str(source), max_side, size="down")
+    if image.interpretation not in ("srgb", "b-w"):
+        image = image.colourspace("srgb")
+    if image.hasalpha():
+        image = image.flatten(background=255)
+    if image.bands == 1:
+        image = image.bandjoin([image, image])
+    if image.format != "uchar":
+        image = image.cast("uchar")
+    return np.ndarray(
+        buffer=image.write_to_memory(), dtype=np.uint8, shape=(image.height, image.width, image.bands)
+    )
+
+
+def load_rgb_array(source: ImageSource) -> np.ndarray:
+    """
+    Load an OCR input as a C-contiguous RGB uint8 array in one step.
+
+    JPEG files and bytes go through TurboJPEG when it is installed;
+    everything else is converted by PIL without an extra copy.
+    """
+    if isinstance(source, np.ndarray):
+        return np.ascontiguousarray(source, dtype=np.uint8)
+
+    if TURBOJPEG_AVAILABLE and not isinstance(source, Image.Image):
+        data = bytes(source) if isinstance(source, (bytes, bytearray)) else Path(source).read_bytes()
+        if data.startswith(b"\xff\xd8\xff"):
+            return _turbo_jpeg.decode(data, pixel_format=TJPF_RGB)
+        source = data
+
+    image_array = np.asarray(ensure_rgb(open_image(source)), dtype=np.uint8)
+    return np.ascontiguousarray(image_array)
+
+
+def encode_image_bytes(source: ImageSource) -> bytes:
+    """
+    Encoded image bytes for sending an OCR input to an inference server.
+
+    Uploads and files are passed through untouched; decoded arrays and PIL
+    images are encoded as lossless PNG.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        return bytes(source)
+    if isinstance(source, (str, Path)):
+        return Path(source).read_bytes()
+    buffer = io.BytesIO()
+    open_image(source).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+# Mean pixel of the Qwen2.5-VL vision encoder (CLIP normalization); padding in it normalizes to ~0
+VIT_MEAN_RGB = (122, 116, 104)
+
+
+def letterbox(image: np.ndarray, side: int, fill=VIT_MEAN_RGB) -> np.ndarray:
+    """
+    Scale an RGB array to fit a side x side square (keeping its aspect ratio)
+    and centre it on a canvas of the fill colour.
+    """
+    height, width = image.shape[:2]
+    scale = side / max(height, width)
+    if scale != 1:
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        image = np.asarray(Image.fromarray(image).resize(size, Image.LANCZOS))
+        height, width = image.shape[:2]
+    canvas = np.empty((side, side, 3), dtype=np.uint8)
+    canvas[:] = fill
+    top, left = (side - height) // 2, (side - width) // 2
+    canvas[top:top + height, left:left + width] = image
+    return canvas
+
+
+def blank_page(side: int = 64) -> np.ndarray:
+    """White RGB array used for warm-up inferences."""
+    return np.full((side, side, 3), 255, dtype=np.uint8)
+
+
+def describe_source(source: ImageSource) -> str:
+    """Short human-readable description of an OCR input for log messages."""
+    if isinstance(source, Image.Image):
+        return f"<in-memory image {source.size[0]}x{source.size[1]}>"
+    if isinstance(source, np.ndarray):
+        return f"<decoded image {source.shape[1]}x{source.shape[0]}>"
+    if isinstance(source, (bytes, bytearray)):
+        return f"<in-memory upload {len(source)} bytes>"
+    return str(source)
+
+
+def sniff_mime(head: bytes) -> Optional[str]:
+    """
+    Classify an upload from its leading bytes.
+
+    Args:
+        head: At least the first SNIFF_BYTES bytes of the file
+
+    Returns:
+        MIME type of a supported format, or None if the content is not recognised
+    """
+    for offset, signature, mime in _MAGIC_SIGNATURES:
+        if head.startswith(signature, offset):
+            if mime == "image/webp" and not head.startswith(b"RIFF"):
+                continue
+            return mime
+    return None
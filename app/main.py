@@ -1,37 +1,95 @@
 """FastAPI server for Qwen2.5-VL OCR system."""
 
 import os
-import uuid
-import aiofiles
+import gzip
+import hashlib
+import tempfile
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 import logging
 
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, JSONResponse, ORJSONResponse, Response
 from fastapi.staticfiles import StaticFiles
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import asyncio
 import json as json_lib
+import multiprocessing
+import importlib.util
+import weakref
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 try:
-    from .qwen_ocr_robust import robust_qwen_ocr
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+def dumps_json(data) -> bytes:
+    """Serialise to UTF-8 JSON bytes, with orjson when it is installed."""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(data)
+    return json_lib.dumps(data).encode("utf-8")
+
+try:
+    from .qwen_ocr_vllm import vllm_qwen_ocr
 except Exception as e:
-    print(f"Failed to import robust_qwen_ocr: {e}")
-    robust_qwen_ocr = None
+    print(f"Failed to import vllm_qwen_ocr: {e}")
+    vllm_qwen_ocr = None
 
-from .paddle_ocr import PaddleOCREngine
+try:
+    from .qwen_ocr_sglang import sglang_qwen_ocr
+except Exception as e:
+    print(f"Failed to import sglang_qwen_ocr: {e}")
+    sglang_qwen_ocr = None
 
-# Initialize OCR engines (lazy loading to prevent startup issues)
-paddle_ocr = None
+try:
+    from .qwen_ocr_llamacpp import llamacpp_qwen_ocr
+except Exception as e:
+    print(f"Failed to import llamacpp_qwen_ocr: {e}")
+    llamacpp_qwen_ocr = None
+
+# A configured vLLM server, SGLang runtime or llama.cpp GGUF model replaces the
+# in-process HF model, which is only imported and loaded on first use (see get_qwen)
+EXTERNAL_QWEN = vllm_qwen_ocr is not None or sglang_qwen_ocr is not None or llamacpp_qwen_ocr is not None
+QWEN_AVAILABLE = EXTERNAL_QWEN or all(
+    importlib.util.find_spec(name) is not None for name in ("torch", "transformers")
+)
 
-def get_paddle_ocr():
-    """Get PaddleOCR instance with lazy loading."""
-    global paddle_ocr
-    if paddle_ocr is None:
-        paddle_ocr = PaddleOCREngine(use_angle_cls=True, lang='en')
-    return paddle_ocr
+from .paddle_worker import extract_text_in_worker, warm_paddle_worker
+from .model_worker import ModelWorkerClient
+from .batching import DynamicBatcher
+from .result_cache import ResultCache, config_fingerprint, content_hash, new_hasher
+from .image_io import SNIFF_BYTES, blank_page, decode_image, sniff_mime
+
+# PaddleOCR settings; each CPU worker process builds its own engine from these
+# (batch sizes default to 1 on CPU and 16 on GPU)
+PADDLE_ENGINE_KWARGS = {
+    "use_angle_cls": True,
+    "lang": "en",
+    "enable_hpi": os.getenv("PADDLE_ENABLE_HPI", "1") == "1"
+}
+
+# OCR runs off the event loop: Qwen on one thread (a single model serialises
+# anyway), CPU-bound PaddleOCR in worker processes to escape the GIL
+_GPU_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="qwen")
+PADDLE_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+_CPU_POOL = ProcessPoolExecutor(
+    max_workers=PADDLE_WORKERS,
+    mp_context=multiprocessing.get_context("spawn")
+)
+# Upper bound on OCR jobs queued or running at once
+MAX_INFLIGHT_OCR = int(os.getenv("MAX_INFLIGHT_OCR", "8"))
+_OCR_SLOTS = asyncio.Semaphore(MAX_INFLIGHT_OCR)
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -39,33 +97,173 @@ logger = logging.getLogger(__name__)
 
 # WebSocket connection manager for progress tracking
 class ConnectionManager:
+    """Progress sockets keyed by request id, so each update goes to one client."""
+
     def __init__(self):
-        self.active_connections: list[WebSocket] = []
+        # Weak values: a socket whose endpoint has exited drops out on its own
+        self.active_connections: "weakref.WeakValueDictionary[str, WebSocket]" = weakref.WeakValueDictionary()
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, request_id: str, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        self.active_connections[request_id] = websocket
 
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+    def disconnect(self, request_id: str, websocket: WebSocket):
+        # A reconnect may already have replaced this socket
+        if self.active_connections.get(request_id) is websocket:
+            del self.active_connections[request_id]
 
-    async def send_progress(self, message: str, progress: int):
-        """Send progress update to all connected clients."""
-        data = {"message": message, "progress": progress}
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(json_lib.dumps(data))
-            except:
-                # Remove disconnected clients
-                self.active_connections.remove(connection)
+    def get(self, request_id: Optional[str]) -> Optional[WebSocket]:
+        return self.active_connections.get(request_id) if request_id else None
+
+    async def send_progress(self, request_id: Optional[str], message: str, progress: int):
+        """Send a progress update to the client that owns request_id, if connected."""
+        websocket = self.get(request_id)
+        if websocket is None:
+            return
+        try:
+            await websocket.send_bytes(dumps_json({"message": message, "progress": progress}))
+        except Exception:
+            # Remove disconnected client
+            self.disconnect(request_id, websocket)
 
 manager = ConnectionManager()
 
+# QWEN_WORKER_PROCESS=1 keeps the HF model in its own process instead of the web
+# process; the server then only talks to it through a queue
+QWEN_WORKER_PROCESS = os.getenv("QWEN_WORKER_PROCESS", "0") == "1"
+qwen_worker = (
+    ModelWorkerClient()
+    if QWEN_WORKER_PROCESS and QWEN_AVAILABLE and not EXTERNAL_QWEN
+    else None
+)
+
+@lru_cache(maxsize=1)
+def get_qwen():
+    """Import and load the in-process Qwen2.5-VL engine on first use (None if unavailable)."""
+    if sglang_qwen_ocr is not None:
+        sglang_qwen_ocr.load_model()
+        return sglang_qwen_ocr
+    if llamacpp_qwen_ocr is not None:
+        llamacpp_qwen_ocr.load_model()
+        return llamacpp_qwen_ocr
+    if qwen_worker is not None:
+        qwen_worker.load_model()
+        return qwen_worker
+    try:
+        from .qwen_ocr_robust import robust_qwen_ocr
+    except Exception as e:
+        logger.error(f"Failed to import robust_qwen_ocr: {e}")
+        return None
+    if robust_qwen_ocr is not None:
+        robust_qwen_ocr.load_model()
+    return robust_qwen_ocr
+
+def qwen_prepare_batch(images, language: str):
+    """Batch preprocessing (image loading + processor), off the GPU thread."""
+    engine = get_qwen()
+    if engine is None:
+        raise RuntimeError("Qwen2.5-VL not available")
+    return engine.prepare_batch(images, language)
+
+def qwen_generate_batch(batch, language: str):
+    """Batch generate() entry point for the GPU thread."""
+    return get_qwen().generate_batch(batch)
+
+# Requests per batched Qwen call and how long the first one waits for company;
+# smaller batches suit CPU hosts, a longer window fills batches under light load
+QWEN_BATCH_KWARGS = {
+    "max_batch_size": max(1, int(os.getenv("QWEN_MAX_BATCH_SIZE", "16"))),
+    "max_wait": float(os.getenv("QWEN_BATCH_WAIT_MS", "10")) / 1000,
+}
+
+# Concurrent Qwen requests are grouped into one generate() call, and the next
+# group is preprocessed on the default thread pool while the GPU thread generates
+# (vLLM batches on the server side, so it needs no local batcher)
+if not QWEN_AVAILABLE or vllm_qwen_ocr is not None:
+    qwen_batcher = None
+elif sglang_qwen_ocr is not None:
+    # The runtime batches continuously; each group goes over as one run_batch()
+    qwen_batcher = DynamicBatcher(sglang_qwen_ocr.extract_text_batch, executor=_GPU_POOL, **QWEN_BATCH_KWARGS)
+elif llamacpp_qwen_ocr is not None:
+    # llama.cpp runs one completion at a time on the GPU thread
+    qwen_batcher = DynamicBatcher(llamacpp_qwen_ocr.extract_text_batch, executor=_GPU_POOL, **QWEN_BATCH_KWARGS)
+elif qwen_worker is not None:
+    # Each group is one call into the worker process
+    qwen_batcher = DynamicBatcher(qwen_worker.extract_text_batch, executor=_GPU_POOL, **QWEN_BATCH_KWARGS)
+else:
+    qwen_batcher = DynamicBatcher(
+        qwen_generate_batch, executor=_GPU_POOL, prepare_fn=qwen_prepare_batch, **QWEN_BATCH_KWARGS
+    )
+
+# Set PREWARM_BLOCKING=1 to hold startup until the models are warm (e.g. behind a
+# load balancer that routes to a worker as soon as its port is open)
+PREWARM_BLOCKING = os.getenv("PREWARM_BLOCKING", "0") == "1"
+
+# Images in the startup warm-up batch; set to the typical batch size so
+# cudnn.benchmark and the allocator settle on production shapes
+QWEN_WARMUP_BATCH = max(1, int(os.getenv("QWEN_WARMUP_BATCH", "1")))
+
+# Which engines have finished loading, filled in by the startup prewarm
+_MODELS_READY = {"paddle": False, "qwen": vllm_qwen_ocr is not None}
+
+# Successful OCR responses keyed by (upload hash, language, model, engine config)
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "1024"))
+# Persistent tier location; set RESULT_CACHE_DIR="" to keep results in memory only
+RESULT_CACHE_DIR = os.path.expanduser(os.getenv("RESULT_CACHE_DIR", "~/.cache/qwen_ocr_system/results"))
+result_cache = ResultCache(maxsize=RESULT_CACHE_SIZE, disk_dir=RESULT_CACHE_DIR)
+# Persisted results only match the engine setup that produced them: changing backend, model,
+# quantization, image sizing etc. (any of these env vars) starts a fresh key space. Bump the
+# version when a code change alters OCR output.
+RESULT_CACHE_VERSION = "1"
+RESULT_CACHE_FINGERPRINT = config_fingerprint(
+    ("QWEN_", "VLLM_", "SGLANG_", "LLAMACPP_", "PADDLE_", "AUTO_"), RESULT_CACHE_VERSION
+)
+
+# Seconds to wait for Qwen2.5-VL before giving up on it (falling back in auto mode)
+QWEN_TIMEOUT = float(os.getenv("QWEN_TIMEOUT", "30"))
+
+# Auto mode accepts PaddleOCR's answer when it is at least this confident (0-100)
+# and the page has fewer text boxes than this; otherwise Qwen2.5-VL is run
+AUTO_MIN_CONFIDENCE = float(os.getenv("AUTO_MIN_CONFIDENCE", "85"))
+AUTO_MAX_BOXES = int(os.getenv("AUTO_MAX_BOXES", "40"))
+
+def is_confident_paddle_result(result: dict) -> bool:
+    """Whether a PaddleOCR result is good enough to skip Qwen in auto mode."""
+    return (
+        result.get("success", True)
+        and not result.get("error")
+        and not result.get("demo_mode")
+        and bool(result.get("text"))
+        and result.get("confidence", 0.0) >= AUTO_MIN_CONFIDENCE
+        and result.get("box_count", 0) < AUTO_MAX_BOXES
+    )
+
+async def run_paddle(image_source, language: str) -> dict:
+    """Run PaddleOCR in the CPU process pool."""
+    async with _OCR_SLOTS:
+        return await asyncio.get_running_loop().run_in_executor(
+            _CPU_POOL, extract_text_in_worker, image_source, language, PADDLE_ENGINE_KWARGS
+        )
+
+async def run_qwen(image_source, language: str) -> dict:
+    """
+    Run Qwen2.5-VL on the vLLM server, or through the batcher (SGLang or the HF model).
+
+    Raises asyncio.TimeoutError if no result arrives within QWEN_TIMEOUT seconds.
+    """
+    async with _OCR_SLOTS:
+        if vllm_qwen_ocr is not None:
+            call = vllm_qwen_ocr.extract_text(image_source, language)
+        else:
+            call = qwen_batcher.submit(image_source, language)
+        return await asyncio.wait_for(call, timeout=QWEN_TIMEOUT)
+
 # Create FastAPI app
 app = FastAPI(
     title="Qwen2.5-VL OCR System",
     description="Production OCR system powered by Qwen2.5-VL-3B-Instruct with PaddleOCR fallback",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse if ORJSON_AVAILABLE else JSONResponse
 )
 
 # Add CORS middleware
@@ -81,8 +279,63 @@ app.add_middleware(
 UPLOAD_DIR = Path("uploads")
 UPLOAD_DIR.mkdir(exist_ok=True)
 
+# Uploads up to this size are OCR'd straight from memory
+MAX_IN_MEMORY_UPLOAD = 50 * 1024 * 1024
+# Larger uploads are streamed to disk in chunks of this size
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Uploads above this size are rejected with 413
+MAX_UPLOAD_SIZE = 200 * 1024 * 1024
+
+# Most files accepted by one /ocr/batch request
+MAX_BATCH_FILES = int(os.getenv("MAX_BATCH_FILES", "16"))
+
+# Multipart framing and the other form fields on top of the file itself
+MAX_REQUEST_SIZE = MAX_UPLOAD_SIZE + 1024 * 1024
+
+class ContentLengthLimitMiddleware:
+    """Reject requests whose declared Content-Length is too large before any body is read."""
+
+    def __init__(self, app, max_body_size: int):
+        self.app = app
+        self.max_body_size = max_body_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            for name, value in scope["headers"]:
+                if name == b"content-length":
+                    if value.isdigit() and int(value) > self.max_body_size:
+                        response = JSONResponse({"detail": "File too large"}, status_code=413)
+                        await response(scope, receive, send)
+                        return
+                    break
+        await self.app(scope, receive, send)
+
+app.add_middleware(ContentLengthLimitMiddleware, max_body_size=MAX_REQUEST_SIZE)
+
+# Accepted upload types; the file content must match one of these
+_ALLOWED_TYPES = frozenset({
+    "image/jpeg", "image/jpg", "image/png",
+    "image/tiff", "image/webp", "application/pdf",
+    "application/octet-stream"  # Allow generic binary files
+})
+_ALLOWED_EXT = frozenset({".jpg", ".jpeg", ".png", ".webp", ".tiff", ".pdf"})
+
+def spool_upload(source, destination, hasher=None) -> int:
+    """Copy an upload into an open file in fixed-size chunks, enforcing MAX_UPLOAD_SIZE."""
+    written = 0
+    while chunk := source.read(UPLOAD_CHUNK_SIZE):
+        written += len(chunk)
+        if written > MAX_UPLOAD_SIZE:
+            raise HTTPException(status_code=413, detail="File too large")
+        if hasher is not None:
+            hasher.update(chunk)
+        destination.write(chunk)
+    destination.flush()
+    return written
+
 # Mount static files
-app.mount("/static", StaticFiles(directory="static"), name="static")
+STATIC_DIR = Path("static")
+app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 
 # Response models
 class OCRResponse(BaseModel):
@@ -102,575 +355,116 @@ class HealthResponse(BaseModel):
     model_loaded: bool
     device: str
 
-@app.get("/", response_class=HTMLResponse)
-async def root():
-    """Serve the main page."""
-    html_content = """
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>Qwen2.5-VL OCR System</title>
-        <style>
-            * {
-                margin: 0;
-                padding: 0;
-                box-sizing: border-box;
-            }
-            
-            body {
-                font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-                background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                min-height: 100vh;
-                padding: 20px;
-            }
-            
-            .container {
-                max-width: 1200px;
-                margin: 0 auto;
-                background: white;
-                border-radius: 20px;
-                box-shadow: 0 20px 40px rgba(0,0,0,0.1);
-                overflow: hidden;
-            }
-            
-            .header {
-                background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                color: white;
-                padding: 30px;
-                text-align: center;
-            }
-            
-            .header h1 {
-                font-size: 2.5em;
-                margin-bottom: 10px;
-            }
-            
-            .header p {
-                font-size: 1.2em;
-                opacity: 0.9;
-            }
-            
-            .content {
-                padding: 40px;
-            }
-            
-            .upload-section {
-                background: #f8f9fa;
-                border: 3px dashed #dee2e6;
-                border-radius: 15px;
-                padding: 40px;
-                text-align: center;
-                margin-bottom: 30px;
-                transition: all 0.3s ease;
-                cursor: pointer;
-            }
-            
-            .upload-section:hover {
-                border-color: #667eea;
-                background: #f0f2ff;
-            }
-            
-            .upload-section.dragover {
-                border-color: #667eea;
-                background: #e3f2fd;
-                transform: scale(1.02);
-            }
-            
-            .upload-icon {
-                font-size: 4em;
-                color: #667eea;
-                margin-bottom: 20px;
-            }
-            
-            .controls {
-                display: grid;
-                grid-template-columns: 1fr 1fr auto;
-                gap: 20px;
-                margin-bottom: 30px;
-                align-items: end;
-            }
-            
-            .form-group {
-                display: flex;
-                flex-direction: column;
-            }
-            
-            .form-group label {
-                font-weight: 600;
-                margin-bottom: 8px;
-                color: #333;
-            }
-            
-            .form-group select,
-            .form-group input {
-                padding: 12px;
-                border: 2px solid #dee2e6;
-                border-radius: 8px;
-                font-size: 16px;
-                transition: border-color 0.3s ease;
-            }
-            
-            .form-group select:focus,
-            .form-group input:focus {
-                outline: none;
-                border-color: #667eea;
-            }
-            
-            .btn {
-                background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                color: white;
-                border: none;
-                padding: 12px 30px;
-                border-radius: 8px;
-                font-size: 16px;
-                font-weight: 600;
-                cursor: pointer;
-                transition: all 0.3s ease;
-                height: fit-content;
-            }
-            
-            .btn:hover {
-                transform: translateY(-2px);
-                box-shadow: 0 10px 20px rgba(102, 126, 234, 0.3);
-            }
-            
-            .btn:disabled {
-                background: #ccc;
-                cursor: not-allowed;
-                transform: none;
-                box-shadow: none;
-            }
-            
-            .results {
-                background: #f8f9fa;
-                border-radius: 15px;
-                padding: 30px;
-                margin-top: 30px;
-                display: none;
-            }
-            
-            .results.show {
-                display: block;
-                animation: slideIn 0.5s ease;
-            }
-            
-            @keyframes slideIn {
-                from {
-                    opacity: 0;
-                    transform: translateY(20px);
-                }
-                to {
-                    opacity: 1;
-                    transform: translateY(0);
-                }
-            }
-            
-            .result-text {
-                background: white;
-                border: 1px solid #dee2e6;
-                border-radius: 8px;
-                padding: 20px;
-                margin: 15px 0;
-                font-family: 'Courier New', monospace;
-                white-space: pre-wrap;
-                max-height: 300px;
-                overflow-y: auto;
-            }
-            
-            .metadata {
-                display: grid;
-                grid-template-columns: repeat(auto-fit, minmax(200px, 1fr));
-                gap: 15px;
-                margin-top: 20px;
-            }
-            
-            .metadata-item {
-                background: white;
-                padding: 15px;
-                border-radius: 8px;
-                border-left: 4px solid #667eea;
-            }
-            
-            .metadata-item .label {
-                font-weight: 600;
-                color: #666;
-                font-size: 0.9em;
-            }
-            
-            .metadata-item .value {
-                font-size: 1.1em;
-                color: #333;
-                margin-top: 5px;
-            }
-            
-            .loading {
-                display: none;
-                text-align: center;
-                padding: 40px;
-            }
-            
-            .loading.show {
-                display: block;
-            }
-            
-            .spinner {
-                border: 4px solid #f3f3f3;
-                border-top: 4px solid #667eea;
-                border-radius: 50%;
-                width: 50px;
-                height: 50px;
-                animation: spin 1s linear infinite;
-                margin: 0 auto 20px;
-            }
-            
-            @keyframes spin {
-                0% { transform: rotate(0deg); }
-                100% { transform: rotate(360deg); }
-            }
-            
-            .error {
-                background: #f8d7da;
-                color: #721c24;
-                border: 1px solid #f5c6cb;
-                border-radius: 8px;
-                padding: 15px;
-                margin: 15px 0;
-            }
-            
-            #fileInput {
-                display: none;
-            }
-            
-            .file-info {
-                margin-top: 15px;
-                padding: 10px;
-                background: #e3f2fd;
-                border-radius: 8px;
-                display: none;
-            }
-            
-            .file-info.show {
-                display: block;
-            }
-
-            .progress-container {
-                background: #f8f9fa;
-                border-radius: 15px;
-                padding: 30px;
-                margin-top: 30px;
-                display: none;
-            }
-
-            .progress-container.show {
-                display: block;
-                animation: slideIn 0.5s ease;
-            }
-
-            .progress-bar {
-                width: 100%;
-                height: 20px;
-                background-color: #e9ecef;
-                border-radius: 10px;
-                overflow: hidden;
-                margin-bottom: 15px;
-            }
-
-            .progress-fill {
-                height: 100%;
-                background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                width: 0%;
-                transition: width 0.3s ease;
-                border-radius: 10px;
-            }
-
-            .progress-text {
-                text-align: center;
-                font-weight: 600;
-                color: #495057;
-                margin-bottom: 10px;
-            }
-
-            .progress-message {
-                text-align: center;
-                color: #6c757d;
-                font-size: 14px;
-            }
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <div class="header">
-                <h1>🤖 Qwen2.5-VL OCR System</h1>
-                <p>Advanced text extraction using Qwen2.5-VL-7B-Instruct model</p>
-            </div>
-            
-            <div class="content">
-                <div class="upload-section" onclick="document.getElementById('fileInput').click()">
-                    <div class="upload-icon">📁</div>
-                    <h3>Drop your image here or click to browse</h3>
-                    <p>Supports: JPG, PNG, WEBP, TIFF, PDF</p>
-                    <input type="file" id="fileInput" accept="image/*,.pdf" onchange="handleFileSelect(event)">
-                    <div class="file-info" id="fileInfo"></div>
-                </div>
-                
-                <div class="controls">
-                    <div class="form-group">
-                        <label for="language">Language</label>
-                        <select id="language">
-                            <option value="eng">English</option>
-                            <option value="urd">Urdu</option>
-                            <option value="ara">Arabic</option>
-                            <option value="fra">French</option>
-                            <option value="deu">German</option>
-                            <option value="spa">Spanish</option>
-                        </select>
-                    </div>
-
-                    <div class="form-group">
-                        <label for="model">OCR Engine</label>
-                        <select id="model">
-                            <option value="qwen">🤖 Qwen2.5-VL-3B (AI Vision)</option>
-                            <option value="paddle">⚡ PaddleOCR (Fast & Reliable)</option>
-                            <option value="auto">🔄 Auto (Qwen → PaddleOCR fallback)</option>
-                        </select>
-                    </div>
-                    
-                    <div class="form-group">
-                        <label for="confidence">Min Confidence</label>
-                        <input type="number" id="confidence" value="50" min="0" max="100">
-                    </div>
-                    
-                    <button class="btn" onclick="processImage()" id="processBtn" disabled>
-                        🚀 Extract Text
-                    </button>
-                </div>
-                
-                <div class="loading" id="loading">
-                    <div class="spinner"></div>
-                    <h3>Processing image with Qwen2.5-VL...</h3>
-                    <p>This may take a few moments</p>
-                </div>
-
-                <div class="progress-container" id="progressContainer">
-                    <h3>📊 Processing Progress</h3>
-                    <div class="progress-text" id="progressText">0%</div>
-                    <div class="progress-bar">
-                        <div class="progress-fill" id="progressFill"></div>
-                    </div>
-                    <div class="progress-message" id="progressMessage">Initializing...</div>
-                </div>
-
-                <div class="results" id="results">
-                    <h3>📄 Extracted Text</h3>
-                    <div class="result-text" id="resultText"></div>
-                    
-                    <div class="metadata" id="metadata"></div>
-                </div>
-            </div>
-        </div>
-        
-        <script>
-            let selectedFile = null;
-            let ws = null;
-
-            // Initialize WebSocket connection for progress updates
-            function initWebSocket() {
-                const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-                const wsUrl = `${protocol}//${window.location.host}/ws`;
-
-                ws = new WebSocket(wsUrl);
-
-                ws.onopen = function() {
-                    console.log('WebSocket connected for progress updates');
-                };
-
-                ws.onmessage = function(event) {
-                    const data = JSON.parse(event.data);
-                    updateProgress(data.message, data.progress);
-                };
-
-                ws.onclose = function() {
-                    console.log('WebSocket disconnected');
-                    // Reconnect after 3 seconds
-                    setTimeout(initWebSocket, 3000);
-                };
-
-                ws.onerror = function(error) {
-                    console.error('WebSocket error:', error);
-                };
-            }
-
-            // Update progress bar and message
-            function updateProgress(message, progress) {
-                const progressContainer = document.getElementById('progressContainer');
-                const progressFill = document.getElementById('progressFill');
-                const progressText = document.getElementById('progressText');
-                const progressMessage = document.getElementById('progressMessage');
-
-                progressFill.style.width = progress + '%';
-                progressText.textContent = progress + '%';
-                progressMessage.textContent = message;
-
-                // Show progress container when processing starts
-                if (progress > 0 && !progressContainer.classList.contains('show')) {
-                    progressContainer.classList.add('show');
-                }
-
-                // Hide progress container when complete
-                if (progress >= 100) {
-                    setTimeout(() => {
-                        progressContainer.classList.remove('show');
-                    }, 2000);
-                }
-            }
-
-            // Initialize WebSocket on page load
-            initWebSocket();
-            
-            // Drag and drop functionality
-            const uploadSection = document.querySelector('.upload-section');
-            
-            uploadSection.addEventListener('dragover', (e) => {
-                e.preventDefault();
-                uploadSection.classList.add('dragover');
-            });
-            
-            uploadSection.addEventListener('dragleave', () => {
-                uploadSection.classList.remove('dragover');
-            });
-            
-            uploadSection.addEventListener('drop', (e) => {
-                e.preventDefault();
-                uploadSection.classList.remove('dragover');
-                const files = e.dataTransfer.files;
-                if (files.length > 0) {
-                    handleFile(files[0]);
-                }
-            });
-            
-            function handleFileSelect(event) {
-                const file = event.target.files[0];
-                if (file) {
-                    handleFile(file);
-                }
-            }
-            
-            function handleFile(file) {
-                selectedFile = file;
-                const fileInfo = document.getElementById('fileInfo');
-                fileInfo.innerHTML = `
-                    <strong>Selected:</strong> ${file.name}<br>
-                    <strong>Size:</strong> ${(file.size / 1024 / 1024).toFixed(2)} MB<br>
-                    <strong>Type:</strong> ${file.type}
-                `;
-                fileInfo.classList.add('show');
-                document.getElementById('processBtn').disabled = false;
-            }
-            
-            async function processImage() {
-                if (!selectedFile) {
-                    alert('Please select an image first');
-                    return;
-                }
-                
-                const formData = new FormData();
-                formData.append('file', selectedFile);
-                formData.append('language', document.getElementById('language').value);
-                formData.append('model', document.getElementById('model').value);
-                
-                // Show loading and reset progress
-                document.getElementById('loading').classList.add('show');
-                document.getElementById('results').classList.remove('show');
-                document.getElementById('progressContainer').classList.remove('show');
-                document.getElementById('processBtn').disabled = true;
-
-                // Reset progress
-                updateProgress('Starting OCR process...', 0);
-                
-                try {
-                    const response = await fetch('/ocr', {
-                        method: 'POST',
-                        body: formData
-                    });
-                    
-                    const result = await response.json();
-                    
-                    if (result.success) {
-                        displayResults(result);
-                    } else {
-                        displayError(result.error || 'OCR processing failed');
-                    }
-                } catch (error) {
-                    displayError('Network error: ' + error.message);
-                } finally {
-                    document.getElementById('loading').classList.remove('show');
-                    document.getElementById('processBtn').disabled = false;
-                    // Progress container will auto-hide after completion
-                }
-            }
-            
-            function displayResults(result) {
-                document.getElementById('resultText').textContent = result.text || 'No text detected';
-                
-                const metadata = document.getElementById('metadata');
-                metadata.innerHTML = `
-                    <div class="metadata-item">
-                        <div class="label">Confidence</div>
-                        <div class="value">${result.confidence.toFixed(1)}%</div>
-                    </div>
-                    <div class="metadata-item">
-                        <div class="label">Language</div>
-                        <div class="value">${result.language}</div>
-                    </div>
-                    <div class="metadata-item">
-                        <div class="label">Engine</div>
-                        <div class="value">${result.engine}</div>
-                    </div>
-                    <div class="metadata-item">
-                        <div class="label">Word Count</div>
-                        <div class="value">${result.word_count}</div>
-                    </div>
-                    <div class="metadata-item">
-                        <div class="label">Processing Time</div>
-                        <div class="value">${result.processing_time.toFixed(2)}s</div>
-                    </div>
-                    <div class="metadata-item">
-                        <div class="label">Device</div>
-                        <div class="value">${result.device}</div>
-                    </div>
-                `;
-                
-                document.getElementById('results').classList.add('show');
-            }
-            
-            function displayError(error) {
-                const results = document.getElementById('results');
-                results.innerHTML = `
-                    <div class="error">
-                        <h3>❌ Error</h3>
-                        <p>${error}</p>
-                    </div>
-                `;
-                results.classList.add('show');
-            }
-        </script>
-    </body>
-    </html>
-    """
-    return HTMLResponse(content=html_content)
+# Index page, read and compressed once at import time
+_INDEX_HTML_BYTES = (STATIC_DIR / "index.html").read_bytes()
+_INDEX_HTML_GZIP = gzip.compress(_INDEX_HTML_BYTES, 9)
+_INDEX_HTML_BROTLI = brotli.compress(_INDEX_HTML_BYTES, quality=11) if BROTLI_AVAILABLE else None
+_INDEX_HTML_ETAG = '"' + hashlib.md5(_INDEX_HTML_BYTES).hexdigest() + '"'
+_INDEX_HTML_HEADERS = {
+    "Cache-Control": "public, max-age=3600",
+    "ETag": _INDEX_HTML_ETAG,
+    "Vary": "Accept-Encoding",
+}
 
-@app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    """WebSocket endpoint for real-time progress updates."""
-    await manager.connect(websocket)
+@app.get("/", response_class=HTMLResponse)
+async def root(request: Request):
+    """Serve the main page from the precompressed bytes."""
+    if request.headers.get("if-none-match") == _INDEX_HTML_ETAG:
+        return Response(status_code=304, headers=_INDEX_HTML_HEADERS)
+
+    accept_encoding = request.headers.get("accept-encoding", "")
+    if _INDEX_HTML_BROTLI is not None and "br" in accept_encoding:
+        content, encoding = _INDEX_HTML_BROTLI, "br"
+    elif "gzip" in accept_encoding:
+        content, encoding = _INDEX_HTML_GZIP, "gzip"
+    else:
+        return Response(content=_INDEX_HTML_BYTES, media_type="text/html; charset=utf-8",
+                        headers=_INDEX_HTML_HEADERS)
+
+    return Response(
+        content=content,
+        media_type="text/html; charset=utf-8",
+        headers={**_INDEX_HTML_HEADERS, "Content-Encoding": encoding}
+    )
+
+async def prewarm_models():
+    """Load the OCR engines in the background so the first request doesn't pay for it."""
+    loop = asyncio.get_running_loop()
+
+    async def warm_paddle():
+        # One warm-up per worker slot; each idle worker tends to take one
+        await asyncio.gather(*(
+            loop.run_in_executor(_CPU_POOL, warm_paddle_worker, PADDLE_ENGINE_KWARGS)
+            for _ in range(PADDLE_WORKERS)
+        ))
+        _MODELS_READY["paddle"] = True
+        logger.info("PaddleOCR workers ready")
+
+    async def warm_qwen():
+        # Loads on the GPU thread, ahead of any queued batch
+        engine = await loop.run_in_executor(_GPU_POOL, get_qwen)
+        if engine is not None and engine.model_loaded:
+            # One dummy generate so CUDA kernels and allocator pools exist before real traffic
+            # (QWEN_WARMUP_BATCH sizes it like production batches)
+            await loop.run_in_executor(
+                _GPU_POOL, engine.extract_text_batch, [blank_page(224)] * QWEN_WARMUP_BATCH, "eng"
+            )
+        _MODELS_READY["qwen"] = engine is not None and engine.model_loaded
+        logger.info(f"Qwen2.5-VL ready: {_MODELS_READY['qwen']}")
+
+    warmups = [warm_paddle()]
+    if qwen_batcher is not None:
+        warmups.append(warm_qwen())
+    results = await asyncio.gather(*warmups, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f"Model prewarm failed: {result}")
+
+@app.on_event("startup")
+async def start_batchers():
+    """Start the background OCR batching task and model prewarm."""
+    if qwen_batcher is not None:
+        qwen_batcher.start()
+    if PREWARM_BLOCKING:
+        # Don't accept connections until every engine has loaded and run once
+        await prewarm_models()
+    else:
+        # Server starts answering immediately; models load alongside
+        app.state.prewarm_task = asyncio.create_task(prewarm_models())
+
+@app.on_event("shutdown")
+async def stop_batchers():
+    """Stop the background OCR batching task."""
+    if qwen_batcher is not None:
+        await qwen_batcher.stop()
+    if vllm_qwen_ocr is not None:
+        await vllm_qwen_ocr.aclose()
+    if sglang_qwen_ocr is not None:
+        sglang_qwen_ocr.shutdown()
+    if llamacpp_qwen_ocr is not None:
+        llamacpp_qwen_ocr.shutdown()
+    if qwen_worker is not None:
+        qwen_worker.stop()
+    result_cache.close()
+    _GPU_POOL.shutdown(wait=False, cancel_futures=True)
+    _CPU_POOL.shutdown(wait=False, cancel_futures=True)
+
+@app.websocket("/ws/{request_id}")
+async def websocket_endpoint(websocket: WebSocket, request_id: str):
+    """WebSocket endpoint for real-time progress updates of one OCR request."""
+    await manager.connect(request_id, websocket)
     try:
+        # Clients never need to send anything: liveness comes from uvicorn's
+        # protocol-level pings (ws_ping_interval/ws_ping_timeout), and a failed
+        # pong or a close arrives here as a disconnect message
         while True:
-            # Keep connection alive
-            await websocket.receive_text()
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
     except WebSocketDisconnect:
-        manager.disconnect(websocket)
+        pass
+    finally:
+        manager.disconnect(request_id, websocket)
 
 @app.get("/")
 async def root():
@@ -680,144 +474,215 @@ async def root():
 @app.get("/health")
 async def health_check():
     """Health check endpoint - responds immediately."""
-    # Ultra-simple health check for Coolify
-    return {"status": "healthy"}
+    # Ultra-simple health check for Coolify; models may still be loading
+    return {
+        "status": "healthy",
+        "model_loaded": any(_MODELS_READY.values()),
+        "models": _MODELS_READY
+    }
 
 @app.post("/ocr", response_model=OCRResponse)
 async def extract_text(
     file: UploadFile = File(...),
     language: str = Form("eng"),
-    model: str = Form("auto")
+    model: str = Form("auto"),
+    request_id: Optional[str] = Form(None)
 ):
     """Extract text from uploaded image using Qwen2.5-VL."""
+    return await process_upload(file, language, model, request_id)
+
+@app.post("/ocr/batch", response_model=List[OCRResponse])
+async def extract_text_batch(
+    files: List[UploadFile] = File(...),
+    language: str = Form("eng"),
+    model: str = Form("auto")
+):
+    """
+    Extract text from several images in one request.
+
+    The images are processed concurrently, so their Qwen2.5-VL passes are
+    grouped by the dynamic batcher into shared generate() calls.
+    """
+    if len(files) > MAX_BATCH_FILES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many files: {len(files)} (max {MAX_BATCH_FILES})"
+        )
+
+    results = await asyncio.gather(
+        *(process_upload(file, language, model) for file in files),
+        return_exceptions=True
+    )
+
+    responses = []
+    for result in results:
+        if isinstance(result, Exception):
+            # One bad file (e.g. unsupported type) doesn't fail the whole batch
+            error = result.detail if isinstance(result, HTTPException) else str(result)
+            result = OCRResponse(
+                success=False, text="", confidence=0.0, language=language,
+                engine="qwen2.5-vl", word_count=0, processing_time=0.0,
+                model_name="", device="", error=error
+            )
+        responses.append(result)
+    return responses
+
+async def process_upload(file: UploadFile, language: str, model: str,
+                         request_id: Optional[str] = None) -> OCRResponse:
+    """Validate, cache-check and OCR one uploaded file."""
     
     # Validate file type
-    allowed_types = {
-        "image/jpeg", "image/jpg", "image/png",
-        "image/tiff", "image/webp", "application/pdf",
-        "application/octet-stream"  # Allow generic binary files
-    }
-
     # Also check file extension if content type is generic
     if file.content_type == "application/octet-stream":
-        allowed_extensions = {".jpg", ".jpeg", ".png", ".webp", ".tiff", ".pdf"}
         file_extension = Path(file.filename).suffix.lower()
-        if file_extension not in allowed_extensions:
+        if file_extension not in _ALLOWED_EXT:
             raise HTTPException(
                 status_code=400,
                 detail=f"Unsupported file extension: {file_extension}"
             )
-    elif file.content_type not in allowed_types:
+    elif file.content_type not in _ALLOWED_TYPES:
         raise HTTPException(
             status_code=400,
             detail=f"Unsupported file type: {file.content_type}"
         )
+
+    # The client-supplied type is only a hint; the magic bytes decide
+    head = await file.read(SNIFF_BYTES)
+    await file.seek(0)
+    detected_type = sniff_mime(head)
+    if detected_type is None:
+        raise HTTPException(
+            status_code=400,
+            detail="File content is not a supported image or PDF"
+        )
     
+    spool = None
     try:
-        # Save uploaded file
-        file_id = str(uuid.uuid4())
-        file_extension = Path(file.filename).suffix
-        file_path = UPLOAD_DIR / f"{file_id}{file_extension}"
-        
-        async with aiofiles.open(file_path, 'wb') as f:
-            content = await file.read()
-            await f.write(content)
+        # Keep the upload in memory and hand the bytes straight to the engines;
+        # very large (or unsized) files are streamed to disk chunk by chunk
+        if file.size is not None and file.size > MAX_UPLOAD_SIZE:
+            raise HTTPException(status_code=413, detail="File too large")
+        if file.size is not None and file.size <= MAX_IN_MEMORY_UPLOAD:
+            image_source = await file.read()
+            digest = content_hash(image_source)
+        else:
+            # Deleted as soon as it is closed in the finally block below
+            spool = tempfile.NamedTemporaryFile(suffix=Path(file.filename).suffix, dir=UPLOAD_DIR)
+            hasher = new_hasher()
+            await asyncio.to_thread(spool_upload, file.file, spool, hasher)
+            image_source = spool.name
+            digest = hasher.hexdigest()
         
         logger.info(f"Processing file: {file.filename} ({file.content_type})")
+
+        # Progress updates go only to the uploader's /ws/{request_id} socket
+        async def report(message: str, progress: int):
+            await manager.send_progress(request_id, message, progress)
+
+        # Identical uploads with the same settings skip OCR entirely
+        cache_key = (digest, language, model, RESULT_CACHE_FINGERPRINT)
+        cached = await result_cache.aget(cache_key)
+        if cached is not None:
+            logger.info(f"Result cache hit for {file.filename}")
+            await report("OCR complete (cached)", 100)
+            return OCRResponse(**cached)
+
+        # Decode and downscale once; both engines (and the auto-mode
+        # fallback) share the same RGB array instead of re-decoding the upload
+        image_source = await asyncio.to_thread(decode_image, image_source)
         
-        # Create progress callback for real-time updates
-        def progress_callback(message: str, progress: int):
-            # Simple synchronous callback that just prints progress
-            # The WebSocket updates will be handled separately
-            print(f"📊 Progress: {progress}% - {message}")
-
-            # Store progress in a simple way that can be accessed by WebSocket
-            if hasattr(progress_callback, 'last_progress'):
-                progress_callback.last_progress = (message, progress)
-            else:
-                progress_callback.last_progress = (message, progress)
+        await report("Image received", 10)
 
         # Model selection based on user choice
         logger.info(f"User selected model: {model}")
 
         if model == "paddle":
             logger.info("User selected: PaddleOCR only")
+            await report("Running PaddleOCR...", 30)
             try:
-                paddle_engine = get_paddle_ocr()
-                result = paddle_engine.extract_text(str(file_path), language, progress_callback)
+                result = await run_paddle(image_source, language)
             except Exception as e:
                 logger.error(f"PaddleOCR failed: {e}")
                 result = {"success": False, "error": str(e), "text": "", "confidence": 0.0}
         elif model == "qwen":
             logger.info("User selected: Qwen2.5-VL only (with timeout protection)")
-            if robust_qwen_ocr is None:
+            if not QWEN_AVAILABLE:
                 logger.error("Qwen2.5-VL not available")
                 result = {"success": False, "error": "Qwen2.5-VL not available", "text": "", "confidence": 0.0}
             else:
+                await report("Running Qwen2.5-VL...", 30)
                 try:
-                    result = robust_qwen_ocr.extract_text(str(file_path), language, progress_callback)
+                    result = await run_qwen(image_source, language)
+                except asyncio.TimeoutError:
+                    logger.warning(f"Qwen2.5-VL timed out after {QWEN_TIMEOUT}s")
+                    result = {"success": False, "error": f"Qwen2.5-VL timed out after {QWEN_TIMEOUT}s",
+                              "text": "", "confidence": 0.0}
                 except Exception as e:
                     logger.error(f"Qwen2.5-VL failed: {e}")
                     result = {"success": False, "error": str(e), "text": "", "confidence": 0.0}
         else:  # model == "auto"
-            logger.info("Auto mode: Qwen2.5-VL → PaddleOCR fallback (memory issues detected)")
-            # Use Qwen2.5-VL-3B as primary OCR engine, PaddleOCR as fallback
-            if robust_qwen_ocr is None:
-                logger.info("Qwen2.5-VL not available, using PaddleOCR only...")
-                paddle_engine = get_paddle_ocr()
-                result = paddle_engine.extract_text(str(file_path), language, progress_callback)
+            logger.info("Auto mode: PaddleOCR → Qwen2.5-VL for hard images")
+            # PaddleOCR is cheap; only low-confidence or dense pages go on to Qwen
+            await report("Running PaddleOCR...", 30)
+            try:
+                paddle_result = await run_paddle(image_source, language)
+            except Exception as e:
+                logger.error(f"PaddleOCR failed: {e}")
+                paddle_result = {"success": False, "error": str(e), "text": "", "confidence": 0.0}
+
+            if is_confident_paddle_result(paddle_result):
+                logger.info("PaddleOCR result is confident, skipping Qwen2.5-VL")
+                result = paddle_result
+            elif not QWEN_AVAILABLE:
+                logger.info("Qwen2.5-VL not available, using PaddleOCR result...")
+                result = paddle_result
             else:
+                logger.info(
+                    f"PaddleOCR confidence {paddle_result.get('confidence', 0.0):.1f}%, "
+                    f"{paddle_result.get('box_count', 0)} boxes - running Qwen2.5-VL..."
+                )
+                await report("Running Qwen2.5-VL...", 60)
                 try:
-                    logger.info("Trying Qwen2.5-VL-3B first (with timeout protection)...")
-                    result = robust_qwen_ocr.extract_text(str(file_path), language, progress_callback)
-
-                    # If Qwen times out, has errors, or fails, fallback to PaddleOCR
-                    if (result.get("timeout_occurred") or result.get("error") or
-                        not result.get("success", True)):
-                        if result.get("timeout_occurred"):
-                            logger.info("Qwen2.5-VL timed out, falling back to PaddleOCR...")
-                        else:
-                            logger.info("Qwen2.5-VL failed, falling back to PaddleOCR...")
-
-                        try:
-                            paddle_engine = get_paddle_ocr()
-                            paddle_result = paddle_engine.extract_text(str(file_path), language, progress_callback)
-                            if paddle_result.get("success", True):
-                                result = paddle_result
-                                logger.info("PaddleOCR fallback successful")
-                        except Exception as paddle_error:
-                            logger.warning(f"PaddleOCR fallback also failed: {paddle_error}")
-                            # Continue with Qwen result (which includes timeout info)
-
+                    result = await run_qwen(image_source, language)
+                except asyncio.TimeoutError:
+                    logger.warning(f"Qwen2.5-VL timed out after {QWEN_TIMEOUT}s")
+                    result = {"success": False, "error": f"Qwen2.5-VL timed out after {QWEN_TIMEOUT}s",
+                              "text": "", "confidence": 0.0}
                 except Exception as e:
                     logger.error(f"Qwen2.5-VL failed: {e}")
-                    # Fallback to PaddleOCR
-                    try:
-                        logger.info("Falling back to PaddleOCR due to Qwen error...")
-                        paddle_engine = get_paddle_ocr()
-                        result = paddle_engine.extract_text(str(file_path), language, progress_callback)
-                    except Exception as paddle_error:
-                        logger.error(f"Both engines failed. Qwen: {e}, PaddleOCR: {paddle_error}")
+                    result = {"success": False, "error": str(e), "text": "", "confidence": 0.0}
+
+                # If Qwen times out, has errors, fails, or was cut short by its time budget
+                # (partial text), keep the PaddleOCR result
+                qwen_failed = bool(result.get("error")) or not result.get("success", True)
+                if qwen_failed or result.get("timeout_occurred"):
+                    if paddle_result.get("success", True):
+                        logger.info("Qwen2.5-VL failed or timed out, using PaddleOCR result")
+                        result = paddle_result
+                    elif not qwen_failed:
+                        logger.info("PaddleOCR failed, keeping the partial Qwen2.5-VL result")
+                    else:
+                        logger.error(
+                            f"Both engines failed. Qwen: {result.get('error')}, "
+                            f"PaddleOCR: {paddle_result.get('error')}"
+                        )
                         result = {
                             "text": "OCR processing failed",
                             "confidence": 0.0,
-                        "language": language,
-                        "engine": "error",
-                        "word_count": 0,
-                        "processing_time": 0.0,
-                        "model_name": "none",
-                        "device": "none",
-                    "error": f"Both engines failed: Qwen: {str(e)}, PaddleOCR: {str(paddle_error)}"
-                }
-        
-        # Clean up uploaded file
-        try:
-            os.unlink(file_path)
-        except:
-            pass
+                            "language": language,
+                            "engine": "error",
+                            "word_count": 0,
+                            "processing_time": 0.0,
+                            "model_name": "none",
+                            "device": "none",
+                            "error": (f"Both engines failed: Qwen: {result.get('error')}, "
+                                      f"PaddleOCR: {paddle_result.get('error')}")
+                        }
         
+        await report("OCR complete", 100)
+
         # Return structured response
-        return OCRResponse(
+        response = OCRResponse(
             success=True,
             text=result.get("text", ""),
             confidence=result.get("confidence", 0.0),
@@ -829,7 +694,14 @@ async def extract_text(
             device=result.get("device", ""),
             error=result.get("error")
         )
+
+        # Only cache real results, never errors or timeouts (including truncated partial text)
+        if not result.get("error") and result.get("success", True) and not result.get("timeout_occurred"):
+            await result_cache.aput(cache_key, jsonable_encoder(response))
+        return response
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"OCR processing failed: {e}")
         return OCRResponse(
@@ -844,7 +716,11 @@ async def extract_text(
             device="",
             error=str(e)
         )
+    finally:
+        if spool is not None:
+            spool.close()
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
+    uvicorn.run(app, host="0.0.0.0", port=8001, loop="auto", http="auto", lifespan="on",
+                ws_ping_interval=20.0, ws_ping_timeout=10.0)
@@ -0,0 +1,191 @@
+"""
+Qwen2.5-VL in a dedicated worker process.
+
+The worker loads the model once and serves calls from a request queue;
+the web process only holds a thin client. Heavy imports happen in the
+worker, never in the server process.
+"""
+
+import itertools
+import logging
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Any, Dict, List, Optional
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Methods of the worker's engine that clients may call
+_ALLOWED_METHODS = frozenset({"load_model", "extract_text_batch"})
+
+# Seconds a client waits for a batch reply, and for a model load (which may download weights)
+CALL_TIMEOUT = 300.0
+LOAD_TIMEOUT = 1800.0
+
+
+def serve_model(requests, replies):
+    """
+    Worker process entry point: load the engine lazily and answer calls until a None request.
+
+    Each request is (call_id, method, args); each reply is (call_id, ok, result_or_error).
+    """
+    from .qwen_ocr_robust import robust_qwen_ocr
+
+    while True:
+        item = requests.get()
+        if item is None:
+            break
+        call_id, method, args = item
+        try:
+            if robust_qwen_ocr is None:
+                raise RuntimeError("Qwen2.5-VL not available in worker")
+            if method not in _ALLOWED_METHODS:
+                raise ValueError(f"Unknown worker method: {method}")
+            replies.put((call_id, True, getattr(robust_qwen_ocr, method)(*args)))
+        except Exception as e:
+            replies.put((call_id, False, f"{type(e).__name__}: {e}"))
+    replies.put(None)
+
+
+class ModelWorkerClient:
+    """
+    Client for a Qwen2.5-VL worker process.
+
+    Mirrors the engine methods the server uses (load_model,
+    extract_text_batch); each call blocks the calling thread until the
+    worker replies, so it runs on an executor like the in-process engine.
+    A worker that dies (e.g. OOM-killed) fails its pending calls and is
+    respawned on the next call; a call that outlives its timeout kills
+    the worker, since the engine's own time budget has already passed.
+    """
+
+    def __init__(self, call_timeout: float = CALL_TIMEOUT, load_timeout: float = LOAD_TIMEOUT):
+        self._context = multiprocessing.get_context("spawn")
+        self.call_timeout = call_timeout
+        self.load_timeout = load_timeout
+        self._requests = None
+        self._process = None
+        self._reader = None
+        self._pending: Dict[int, Future] = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self.model_loaded = False
+
+    def start(self) -> bool:
+        """Spawn the worker process and its reply reader unless one is running; True if it spawned."""
+        with self._lock:
+            return self._start_locked()
+
+    def _start_locked(self) -> bool:
+        if self._process is not None and self._process.is_alive():
+            return False
+        if self._process is not None:
+            logger.warning(f"⚠️ Qwen worker process (pid {self._process.pid}) is gone, respawning")
+        # Fresh queues and pending map per process, so nothing meant for a dead worker leaks into the new one
+        self._requests = self._context.Queue()
+        replies = self._context.Queue()
+        self._pending = {}
+        self._process = self._context.Process(
+            target=serve_model, args=(self._requests, replies),
+            name="qwen-worker", daemon=True
+        )
+        self._process.start()
+        self._reader = threading.Thread(
+            target=self._read_replies, args=(self._process, replies, self._pending),
+            name="qwen-worker-replies", daemon=True
+        )
+        self._reader.start()
+        self.model_loaded = False
+        logger.info(f"🚀 Qwen worker process started (pid {self._process.pid})")
+        return True
+
+    def stop(self, timeout: float = 10.0):
+        """Ask the worker to exit and wait for it."""
+        with self._lock:
+            process, self._process = self._process, None
+        if process is None:
+            return
+        if process.is_alive():
+            self._requests.put(None)
+            process.join(timeout)
+        if process.is_alive():
+            process.terminate()
+
+    def call(self, method: str, *args, timeout: Optional[float] = None) -> Any:
+        """
+        Run an engine method in the worker and return its result.
+
+        A respawned worker loads the model first (under load_timeout), so the
+        call itself is not charged for the load.
+        """
+        if self.start() and method != "load_model":
+            self.load_model()
+        with self._lock:
+            # Fail fast rather than queue a request nobody will answer
+            if self._process is None:
+                raise RuntimeError("Qwen worker process exited")
+            if self._reader is None or not self._reader.is_alive():
+                raise RuntimeError("Qwen worker reply reader is not running")
+            process, requests, pending = self._process, self._requests, self._pending
+            call_id = next(self._ids)
+            future: Future = Future()
+            pending[call_id] = future
+        requests.put((call_id, method, args))
+
+        timeout = self.call_timeout if timeout is None else timeout
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            with self._lock:
+                pending.pop(call_id, None)
+            logger.error(f"❌ Qwen worker did not answer {method} within {timeout:.0f}s, terminating it")
+            # The reader then fails any other pending calls; the next call respawns the worker
+            process.terminate()
+            raise TimeoutError(f"Qwen worker did not answer {method} within {timeout:.0f}s")
+
+    def load_model(self) -> bool:
+        """Load the model in the worker."""
+        self.model_loaded = bool(self.call("load_model", timeout=self.load_timeout))
+        return self.model_loaded
+
+    def extract_text_batch(self, images: List[Any], language: str = "eng") -> List[Dict[str, Any]]:
+        """Batched OCR in the worker; images must be picklable (paths, bytes or arrays)."""
+        return self.call("extract_text_batch", images, language)
+
+    def _read_replies(self, process, replies, pending: Dict[int, Future]):
+        """Resolve one worker's pending calls as replies arrive; fail them all if it dies."""
+        while True:
+            try:
+                reply = replies.get(timeout=1.0)
+            except queue.Empty:
+                if process.is_alive():
+                    continue
+                reply = None
+            if reply is None:
+                self._fail_pending(process, pending, RuntimeError("Qwen worker process exited"))
+                return
+
+            call_id, ok, result = reply
+            with self._lock:
+                future = pending.pop(call_id, None)
+            if future is None:
+                continue
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(RuntimeError(result))
+
+    def _fail_pending(self, process, pending: Dict[int, Future], error: Exception):
+        with self._lock:
+            futures = list(pending.values())
+            pending.clear()
+            # Forget the dead process so the next call() respawns instead of queueing to nobody
+            if self._process is process:
+                self._process = None
+                self.model_loaded = False
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
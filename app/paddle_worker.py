@@ -0,0 +1,38 @@
+"""
+Process-pool entry points for PaddleOCR.
+
+Kept free of heavy imports so the server process never loads PaddleOCR;
+each worker imports and builds its engine on first use.
+"""
+
+import os
+from functools import lru_cache
+from typing import Any, Dict
+
+from .image_io import ImageSource, blank_page
+
+
+@lru_cache(maxsize=1)
+def get_paddle(**engine_kwargs):
+    """This worker's PaddleOCR engine, created on first call and reused afterwards."""
+    from .paddle_ocr import PaddleOCREngine
+    return PaddleOCREngine(**engine_kwargs)
+
+
+def warm_paddle_worker(engine_kwargs: Dict[str, Any] = None) -> int:
+    """
+    Load the engine in whichever worker runs this and push one blank page
+    through it, so predictor setup is done before real traffic; returns its pid.
+    """
+    get_paddle(**(engine_kwargs or {})).extract_text(blank_page())
+    return os.getpid()
+
+
+def extract_text_in_worker(image_path: ImageSource, language: str = "eng",
+                           engine_kwargs: Dict[str, Any] = None) -> Dict[str, Any]:
+    """
+    Process-pool entry point: run OCR with this process's own engine.
+
+    Progress callbacks cannot cross the process boundary, so none is passed.
+    """
+    return get_paddle(**(engine_kwargs or {})).extract_text(image_path, language)
@@ -0,0 +1,214 @@
+"""Qwen2.5-VL input building: per-language prompt tokens and vision encoder outputs cached across requests."""
+
+import logging
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+try:
+    import torch
+    from transformers import BatchFeature
+    TRANSFORMERS_AVAILABLE = True
+except ImportError:
+    TRANSFORMERS_AVAILABLE = False
+
+IMAGE_PAD_TOKEN = "<|image_pad|>"
+
+# Languages offered by the web UI; their prompt tokens are prepared at load time
+SUPPORTED_LANGUAGES = ("eng", "urd", "ara", "fra", "deu", "spa")
+
+
+class PromptTokenCache:
+    """
+    Build processor-equivalent model inputs without re-templating or
+    re-tokenizing the fixed text on every request.
+
+    The chat-templated prompt for a language is split at the image
+    placeholder and both halves are tokenized once. Per request only the
+    image processor runs; its grid size gives the number of image-pad
+    tokens spliced between the cached halves. The first build for each
+    language is compared with the full processor output, and the cache
+    disables itself if they ever differ.
+    """
+
+    def __init__(self, processor, prompt_fn: Callable[[str], str]):
+        self.processor = processor
+        self.prompt_fn = prompt_fn
+        self.tokenizer = processor.tokenizer
+        self.image_pad_id = self.tokenizer.convert_tokens_to_ids(IMAGE_PAD_TOKEN)
+        self.merge_size = getattr(processor.image_processor, "merge_size", 2)
+        self.enabled = True
+        self._parts: Dict[str, Tuple[List[int], List[int], str]] = {}
+        self._verified: Set[str] = set()
+
+    def _prompt_parts(self, language: str) -> Tuple[List[int], List[int], str]:
+        """Token ids before and after the image placeholder, plus the full prompt text."""
+        if language not in self._parts:
+            messages = [{
+                "role": "user",
+                "content": [
+                    {"type": "image"},
+                    {"type": "text", "text": self.prompt_fn(language)}
+                ]
+            }]
+            text = self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+            prefix, suffix = text.split(IMAGE_PAD_TOKEN, 1)
+            self._parts[language] = (
+                self.tokenizer(prefix, add_special_tokens=False).input_ids,
+                self.tokenizer(suffix, add_special_tokens=False).input_ids,
+                text
+            )
+        return self._parts[language]
+
+    def prompt_text(self, language: str) -> str:
+        """Chat-templated prompt for a language (computed once)."""
+        return self._prompt_parts(language)[2]
+
+    def warm(self, languages: Iterable[str], image: Any) -> bool:
+        """
+        Template, tokenize and verify every language up front with a dummy image,
+        so no request pays for the first-use work.
+
+        Returns False if any language could not be built (e.g. a chat
+        template without an image placeholder).
+        """
+        for language in languages:
+            try:
+                self.build([image], language)
+            except Exception as e:
+                logger.warning(f"Prompt token cache warm-up failed for {language}: {e}")
+                return False
+        logger.info(f"Prompt tokens cached for {len(self._parts)} languages")
+        return True
+
+    def build(self, images: List, language: str) -> "BatchFeature":
+        """
+        Model inputs for a batch of images sharing one language.
+
+        Sequences are left-padded, matching the processor with
+        padding_side="left".
+        """
+        prefix_ids, suffix_ids, text = self._prompt_parts(language)
+        if not self.enabled:
+            return self.processor(text=[text] * len(images), images=images, padding=True, return_tensors="pt")
+
+        vision = self.processor.image_processor(images=images, return_tensors="pt")
+        grid_thw = vision["image_grid_thw"]
+        pad_counts = (grid_thw.prod(dim=-1) // (self.merge_size ** 2)).tolist()
+
+        sequences = [prefix_ids + [self.image_pad_id] * count + suffix_ids for count in pad_counts]
+        longest = max(len(sequence) for sequence in sequences)
+        pad_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
+
+        input_ids = torch.full((len(sequences), longest), pad_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(sequences), longest), dtype=torch.long)
+        for row, sequence in enumerate(sequences):
+            input_ids[row, longest - len(sequence):] = torch.tensor(sequence, dtype=torch.long)
+            attention_mask[row, longest - len(sequence):] = 1
+
+        inputs = BatchFeature(data={
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "pixel_values": vision["pixel_values"],
+            "image_grid_thw": grid_thw,
+        })
+
+        if language not in self._verified:
+            self._verify(inputs, images, text, language)
+        return inputs
+
+    def _verify(self, inputs: "BatchFeature", images: List, text: str, language: str):
+        """One-time check that the spliced ids match the processor's own output."""
+        reference = self.processor(text=[text] * len(images), images=images, padding=True, return_tensors="pt")
+        if torch.equal(reference["input_ids"], inputs["input_ids"]):
+            self._verified.add(language)
+            logger.info(f"Prompt token cache verified for language: {language}")
+        else:
+            self.enabled = False
+            logger.warning("Prompt token cache does not match the processor - falling back to full processing")
+            inputs.update(reference)
+
+
+class VisionEmbeddingCache:
+    """
+    Run the vision encoder separately from generate() and keep its output.
+
+    embed() turns processor inputs into generate() arguments that carry
+    inputs_embeds (text embeddings with the image features scattered into
+    the image-pad positions) instead of pixel_values. Each image's features
+    are cached under a caller-supplied key (e.g. a content hash), so OCR of
+    a repeated image skips the ViT entirely. input_ids and image_grid_thw
+    are still passed so the model can build its M-RoPE positions.
+    """
+
+    def __init__(self, model, maxsize: int = 32):
+        self.model = model
+        self.maxsize = maxsize
+        self.visual = getattr(model, "visual", None) or getattr(getattr(model, "model", None), "visual", None)
+        self.image_token_id = getattr(model.config, "image_token_id", None)
+        self.merge_size = getattr(self.visual, "spatial_merge_size", 2)
+        self._entries: "OrderedDict[Hashable, torch.Tensor]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def supported(self) -> bool:
+        """Whether the loaded model exposes a separate vision tower."""
+        return self.maxsize > 0 and self.visual is not None and self.image_token_id is not None
+
+    def embed(self, inputs, keys: List[Optional[Hashable]]) -> Dict[str, Any]:
+        """
+        generate() arguments for a processor batch, one cache key per image.
+
+        Images with a None key are encoded but not cached.
+        """
+        grid_thw = inputs["image_grid_thw"]
+        patch_counts = grid_thw.prod(dim=-1).tolist()
+        token_counts = [count // (self.merge_size ** 2) for count in patch_counts]
+
+        # Take cached features first, so this batch's own inserts can't evict them
+        features: List[Optional["torch.Tensor"]] = [
+            self._lookup(key) if key is not None and key in self._entries else None
+            for key in keys
+        ]
+        missing = [index for index, feature in enumerate(features) if feature is None]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            pixel_chunks = inputs["pixel_values"].split(patch_counts)
+            encoded = self.visual(
+                torch.cat([pixel_chunks[index] for index in missing]),
+                grid_thw=grid_thw[missing]
+            )
+            for index, feature in zip(missing, encoded.split([token_counts[index] for index in missing])):
+                features[index] = feature
+                if keys[index] is not None:
+                    self._remember(keys[index], feature)
+
+        image_features = torch.cat(features)
+
+        input_ids = inputs["input_ids"]
+        inputs_embeds = self.model.get_input_embeddings()(input_ids)
+        image_mask = (input_ids == self.image_token_id).unsqueeze(-1).expand_as(inputs_embeds)
+        inputs_embeds = inputs_embeds.masked_scatter(image_mask, image_features.to(inputs_embeds.dtype))
+
+        return {
+            "input_ids": input_ids,
+            "attention_mask": inputs["attention_mask"],
+            "inputs_embeds": inputs_embeds,
+            "image_grid_thw": grid_thw,
+        }
+
+    def _lookup(self, key: Hashable) -> "torch.Tensor":
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def _remember(self, key: Hashable, feature: "torch.Tensor"):
+        self._entries[key] = feature
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
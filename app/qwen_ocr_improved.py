@@ -4,9 +4,18 @@ Based on the approach that works better on Apple Silicon
 """
 
 import logging
+import os
+import re
 import time
 from pathlib import Path
-from typing import Dict, Any, Optional, Callable
+from typing import Dict, Any, List, Optional, Callable, Union
+
+from .image_io import ImageSource, decode_image, open_image
+from .generation import (
+    BITSANDBYTES_AVAILABLE, CPU_QUANTIZATIONS, TokenProgress, accelerator_dtype, attn_implementation,
+    compile_forward, compile_setting, cpu_torch_dtype, default_cpu_quantization, nf4_load_kwargs,
+    optimize_for_cpu, pick_device, probe_mps
+)
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -15,7 +24,7 @@ logger = logging.getLogger(__name__)
 # Check for dependencies
 try:
     import torch
-    from transformers import AutoProcessor, AutoModelForVision2Seq
+    from transformers import AutoProcessor, AutoModelForVision2Seq, StoppingCriteriaList
     from PIL import Image
     import numpy as np
     TRANSFORMERS_AVAILABLE = True
@@ -24,15 +33,36 @@ except ImportError as e:
     TRANSFORMERS_AVAILABLE = False
     logger.error(f"❌ Missing dependencies: {e}")
 
+# Boilerplate the model sometimes puts before the transcription
+RESPONSE_PREFIXES = (
+    "The text in the image is:",
+    "The text written in this image is:",
+    "The image contains the following text:",
+    "I can see the following text:",
+    "The text reads:",
+)
+_RESPONSE_PREFIX_RE = re.compile(
+    r"^(?:" + "|".join(map(re.escape, RESPONSE_PREFIXES)) + r")\s*", re.IGNORECASE
+)
+
+
 class ImprovedQwenOCR:
     """
     Improved Qwen2.5-VL OCR Engine optimized for M1 Pro
     Uses AutoModelForVision2Seq for better compatibility
     """
     
-    def __init__(self, model_name: str = "Qwen/Qwen2.5-VL-3B-Instruct"):
+    def __init__(self, model_name: str = "Qwen/Qwen2.5-VL-3B-Instruct", compile_model: Union[bool, str] = False,
+                 quantization: str = "fp32", device: Optional[str] = None):
         self.model_name = model_name
-        self.device = "cpu"  # Force CPU for M1 Pro stability
+        self.compile_model = compile_model  # torch.compile forward + warm-up at load time
+        # CPU weight format: "fp32", "bf16" (IPEX on x86 when installed) or "int8" (dynamic quantization)
+        if quantization not in CPU_QUANTIZATIONS:
+            logger.warning(f"⚠️ Unknown quantization {quantization!r}, using fp32")
+            quantization = "fp32"
+        self.quantization = quantization
+        # CUDA, then MPS on Apple Silicon, then CPU; MPS falls back to CPU if its load-time probe fails
+        self.device = device or (pick_device() if TRANSFORMERS_AVAILABLE else "cpu")
         self.model = None
         self.processor = None
         self.model_loaded = False
@@ -40,22 +70,6 @@ class ImprovedQwenOCR:
         logger.info(f"🤖 Improved Qwen OCR Engine initialized")
         logger.info(f"📱 Device: {self.device}")
         logger.info(f"🎯 Model: {self.model_name}")
-        
-        # Check device capabilities
-        if TRANSFORMERS_AVAILABLE:
-            self._check_device_capabilities()
-    
-    def _check_device_capabilities(self):
-        """Check what devices are available."""
-        try:
-            if torch.cuda.is_available():
-                logger.info("🔥 CUDA available but using CPU for stability")
-            
-            if hasattr(torch.backends, 'mps') and torch.backends.mps.is_available():
-                logger.info("🍎 MPS (Apple Silicon) available but using CPU for stability")
-                
-        except Exception as e:
-            logger.info(f"⚠️ Device check failed: {e}")
     
     def load_model(self, progress_callback: Optional[Callable] = None):
         """Load the Qwen2.5-VL model and processor."""
@@ -80,21 +94,56 @@ class ImprovedQwenOCR:
                 self.model_name,
                 trust_remote_code=True
             )
+            # Left-pad so batched prompts all end right before the generated tokens
+            self.processor.tokenizer.padding_side = "left"
             logger.info("✅ Processor loaded")
             
             # Load model with optimized settings for M1 Pro
             if progress_callback:
                 progress_callback("Loading vision-language model...", 40)
             
-            self.model = AutoModelForVision2Seq.from_pretrained(
-                self.model_name,
-                torch_dtype=torch.float32,  # Use float32 for M1 Pro compatibility
-                device_map=None,  # Don't use device_map on M1 Pro
-                trust_remote_code=True,
-                low_cpu_mem_usage=True  # Optimize memory usage
-            ).to(self.device)
-            
-            logger.info("✅ Model loaded successfully")
+            # Half precision on GPUs; on CPU float32 unless bf16 was requested
+            dtype = cpu_torch_dtype(self.quantization) if self.device == "cpu" else accelerator_dtype(self.device)
+            attention = attn_implementation(self.device, dtype)
+            # NF4 4-bit weights on CUDA when bitsandbytes is installed (placed by device_map)
+            quantized = self.device == "cuda" and BITSANDBYTES_AVAILABLE
+            load_kwargs = nf4_load_kwargs() if quantized else {
+                "device_map": None  # Don't use device_map on M1 Pro
+            }
+            for fallback in (False, True):
+                try:
+                    self.model = AutoModelForVision2Seq.from_pretrained(
+                        self.model_name,
+                        torch_dtype=dtype,
+                        trust_remote_code=True,
+                        low_cpu_mem_usage=True,  # Optimize memory usage
+                        attn_implementation=attention,
+                        **load_kwargs
+                    )
+                    if not quantized:
+                        self.model = self.model.to(self.device)
+                    break
+                except (ImportError, ValueError) as e:
+                    # FlashAttention-2 missing at runtime, or SDPA unsupported by a remote-code model
+                    if fallback:
+                        raise
+                    attention = "sdpa" if attention == "flash_attention_2" else "eager"
+                    logger.warning(f"⚠️ Attention backend unavailable ({e}), retrying with {attention}")
+            
+            logger.info(f"✅ Model loaded successfully (attention: {attention})")
+
+            self.model, self.device = probe_mps(self.model, self.device, self._probe)
+
+            if self.device == "cpu" and self.quantization != "fp32":
+                self.model = optimize_for_cpu(self.model, self.quantization)
+
+            if torch.cuda.is_available():
+                # Let cuDNN pick the fastest kernels for the vision patch-embedding conv
+                torch.backends.cudnn.benchmark = True
+
+            if self.compile_model and hasattr(torch, "compile"):
+                compile_forward(self.model, self.device, self.compile_model)
+                self._warm_up()
             
             if progress_callback:
                 progress_callback("Model ready for inference", 60)
@@ -106,6 +155,41 @@ class ImprovedQwenOCR:
             logger.error(f"❌ Failed to load model: {e}")
             return False
     
+    def prewarm(self) -> bool:
+        """Load the model and run one dummy inference (call from server startup)."""
+        if not self.load_model():
+            return False
+        self.extract_text(Image.new("RGB", (224, 224), "white"))
+        return True
+
+    def _probe(self):
+        """One-token generate() on a blank page, used to verify the device at load time."""
+        inputs = self.processor(
+            text=self._create_ocr_prompt("eng"),
+            images=Image.new("RGB", (64, 64), "white"),
+            return_tensors="pt"
+        ).to(self.device)
+        self.model.generate(**inputs, max_new_tokens=1, do_sample=False, num_beams=1)
+
+    def _warm_up(self):
+        """Run one short generate() so compilation happens before the first request."""
+        logger.info("🔥 Warming up compiled model (one-time compile)...")
+        start_time = time.time()
+        try:
+            inputs = self.processor(
+                text=self._create_ocr_prompt("eng"),
+                images=Image.new("RGB", (512, 512), "white"),
+                return_tensors="pt"
+            ).to(self.device)
+            with torch.inference_mode():
+                self.model.generate(**inputs, max_new_tokens=4, do_sample=False, num_beams=1)
+        except Exception as e:
+            # Fall back to the eager forward rather than failing the load
+            logger.warning(f"⚠️ Compiled warm-up failed ({e}), using eager forward")
+            del self.model.forward
+            return
+        logger.info(f"✅ Warm-up finished in {time.time() - start_time:.1f}s")
+
     def extract_text(self, image_path: str, language: str = "eng", 
                     progress_callback: Optional[Callable] = None) -> Dict[str, Any]:
         """
@@ -138,7 +222,7 @@ class ImprovedQwenOCR:
             
             # Load image
             try:
-                image = Image.open(image_path).convert("RGB")
+                image = open_image(image_path).convert("RGB")
                 logger.info(f"✅ Image loaded: {image.size}")
             except Exception as e:
                 logger.error(f"❌ Failed to load image: {e}")
@@ -164,30 +248,19 @@ class ImprovedQwenOCR:
             
             logger.info("🎯 Generating text...")
             
-            with torch.no_grad():
-                generated_ids = self.model.generate(
-                    **inputs,
-                    max_new_tokens=128,  # Conservative for M1 Pro
-                    min_new_tokens=1,
-                    do_sample=False,     # Deterministic
-                    num_beams=1,         # No beam search for speed
-                    pad_token_id=self.processor.tokenizer.eos_token_id,
-                    eos_token_id=self.processor.tokenizer.eos_token_id,
-                    use_cache=True,
-                    temperature=None,    # Remove temperature
-                    top_p=None,         # Remove top_p
-                    top_k=None          # Remove top_k
-                )
+            generation_kwargs = self._generation_kwargs()
+            if progress_callback:
+                # Progress every 16 tokens instead of one jump at the end
+                generation_kwargs["stopping_criteria"] = StoppingCriteriaList([TokenProgress(
+                    progress_callback, inputs["input_ids"].shape[1], generation_kwargs["max_new_tokens"]
+                )])
+
+            with torch.inference_mode():
+                generated_ids = self.model.generate(**inputs, **generation_kwargs)
             
-            # Decode output
+            # Decode only the new tokens and strip any response boilerplate
             logger.info("📝 Decoding output...")
-            output = self.processor.batch_decode(
-                generated_ids, 
-                skip_special_tokens=True
-            )[0]
-            
-            # Extract the actual OCR text from the response
-            extracted_text = self._extract_ocr_text(output, prompt)
+            extracted_text = self._extract_ocr_text(self._decode(generated_ids, inputs)[0])
             
             processing_time = time.time() - start_time
             
@@ -197,21 +270,87 @@ class ImprovedQwenOCR:
             logger.info(f"✅ OCR completed in {processing_time:.2f}s")
             logger.info(f"📄 Extracted text length: {len(extracted_text)} characters")
             
-            return {
-                "text": extracted_text,
-                "confidence": 95.0,  # Qwen typically has high confidence
-                "language": language,
-                "engine": "Qwen2.5-VL-3B-Instruct",
-                "word_count": len(extracted_text.split()) if extracted_text else 0,
-                "processing_time": processing_time,
-                "model_name": self.model_name,
-                "device": self.device,
-                "success": True
-            }
+            return self._create_success_response(extracted_text, language, start_time)
             
         except Exception as e:
             logger.error(f"❌ OCR failed: {e}")
             return self._create_error_response(str(e), start_time)
+
+    def extract_text_batch(self, image_paths: List[ImageSource], language: str = "eng") -> List[Dict[str, Any]]:
+        """
+        Extract text from several images with one padded processor call and one generate().
+
+        Images are decoded and capped at MAX_IMAGE_SIDE first. Images that fail
+        to load get an error response; returns one result per input, in order.
+        """
+        start_time = time.time()
+        if not self.model_loaded and not self.load_model():
+            return [self._create_error_response("Failed to load model", start_time) for _ in image_paths]
+
+        results: List[Optional[Dict[str, Any]]] = [None] * len(image_paths)
+        batch_indices, images = [], []
+        for index, image_path in enumerate(image_paths):
+            try:
+                images.append(decode_image(image_path))
+                batch_indices.append(index)
+            except Exception as e:
+                results[index] = self._create_error_response(f"Failed to load image: {e}", start_time)
+
+        if images:
+            try:
+                prompt = self._create_ocr_prompt(language)
+                inputs = self.processor(
+                    text=[prompt] * len(images),
+                    images=images,
+                    padding=True,
+                    return_tensors="pt"
+                ).to(self.device)
+
+                logger.info(f"🎯 Generating text for batch of {len(images)}...")
+                with torch.inference_mode():
+                    generated_ids = self.model.generate(**inputs, **self._generation_kwargs())
+
+                outputs = self._decode(generated_ids, inputs)
+                for index, output in zip(batch_indices, outputs):
+                    results[index] = self._create_success_response(
+                        self._extract_ocr_text(output), language, start_time
+                    )
+            except Exception as e:
+                logger.error(f"❌ Batch OCR failed: {e}")
+                for index in batch_indices:
+                    results[index] = self._create_error_response(str(e), start_time)
+
+        logger.info(f"✅ Batch OCR of {len(image_paths)} images completed in {time.time() - start_time:.2f}s")
+        return results
+
+    def _generation_kwargs(self) -> Dict[str, Any]:
+        """Greedy decoding settings shared by the single and batched paths."""
+        return {
+            "max_new_tokens": 128,  # Conservative for M1 Pro
+            "min_new_tokens": 1,
+            "do_sample": False,     # Deterministic
+            "num_beams": 1,         # No beam search for speed
+            "pad_token_id": self.processor.tokenizer.eos_token_id,
+            "eos_token_id": self.processor.tokenizer.eos_token_id,
+            "use_cache": True,
+            "temperature": None,    # Remove temperature
+            "top_p": None,          # Remove top_p
+            "top_k": None           # Remove top_k
+        }
+
+    def _create_success_response(self, extracted_text: str, language: str, start_time: float) -> Dict[str, Any]:
+        """Create a standardized success response."""
+        return {
+            "text": extracted_text,
+            "confidence": 95.0,  # Qwen typically has high confidence
+            "language": language,
+            "engine": "Qwen2.5-VL-3B-Instruct",
+            "word_count": len(extracted_text.split()) if extracted_text else 0,
+            "processing_time": time.time() - start_time,
+            "model_name": self.model_name,
+            "device": self.device,
+            "success": True
+        }
     
     def _create_ocr_prompt(self, language: str) -> str:
         """Create an appropriate OCR prompt for the given language."""
@@ -220,33 +359,17 @@ class ImprovedQwenOCR:
         else:
             return "<|im_start|>user\nWhat is the text written in this image? Please transcribe all text accurately.\n<|im_end|>\n<|im_start|>assistant\n"
     
-    def _extract_ocr_text(self, full_output: str, prompt: str) -> str:
-        """Extract the actual OCR text from the model's full response."""
-        try:
-            # Remove the prompt from the output
-            if prompt in full_output:
-                text = full_output.replace(prompt, "").strip()
-            else:
-                text = full_output.strip()
-            
-            # Remove common response prefixes
-            prefixes_to_remove = [
-                "The text in the image is:",
-                "The text written in this image is:",
-                "The image contains the following text:",
-                "I can see the following text:",
-                "The text reads:",
-            ]
-            
-            for prefix in prefixes_to_remove:
-                if text.startswith(prefix):
-                    text = text[len(prefix):].strip()
-            
-            return text
-            
-        except Exception as e:
-            logger.warning(f"⚠️ Text extraction failed: {e}")
-            return full_output.strip()
+    def _decode(self, generated_ids, inputs) -> List[str]:
+        """Decode only the generated tokens (prompts are left-padded to a common length)."""
+        # Slice on the device, then copy the new tokens to the host once
+        return self.processor.batch_decode(
+            generated_ids[:, inputs["input_ids"].shape[1]:].cpu(),
+            skip_special_tokens=True, clean_up_tokenization_spaces=False
+        )
+
+    def _extract_ocr_text(self, output: str) -> str:
+        """Strip whitespace and a common response prefix from the decoded answer."""
+        return _RESPONSE_PREFIX_RE.sub("", output.strip(), count=1)
     
     def _create_error_response(self, error_message: str, start_time: float) -> Dict[str, Any]:
         """Create a standardized error response."""
@@ -264,4 +387,8 @@ class ImprovedQwenOCR:
         }
 
 # Create global instance
-improved_qwen_ocr = ImprovedQwenOCR() if TRANSFORMERS_AVAILABLE else None
+improved_qwen_ocr = ImprovedQwenOCR(
+    compile_model=compile_setting(os.getenv("QWEN_TORCH_COMPILE", "0")),
+    quantization=os.getenv("QWEN_CPU_QUANTIZATION") or default_cpu_quantization(),
+    device=os.getenv("QWEN_DEVICE") or None
+) if TRANSFORMERS_AVAILABLE else None
@@ -0,0 +1,182 @@
+"""
+Qwen2.5-VL OCR Engine backed by llama.cpp
+Runs a GGUF build of the model through llama-cpp-python, so Apple Silicon gets
+Metal kernels and quantized weights instead of HF generate() on CPU
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import Dict, Any, List
+
+from .image_io import ImageSource, describe_source
+from .qwen_ocr_vllm import encode_image_data_url, parse_chat_response
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Check for dependencies
+try:
+    from llama_cpp import Llama
+    from llama_cpp.llama_chat_format import Qwen25VLChatHandler
+    LLAMACPP_AVAILABLE = True
+except ImportError:
+    LLAMACPP_AVAILABLE = False
+    logger.info("llama-cpp-python not available - llama.cpp backend disabled")
+
+
+class LlamaCppQwenOCR:
+    """
+    Qwen2.5-VL OCR Engine running a GGUF model in-process with llama.cpp
+    Needs the language model GGUF plus its vision projector (mmproj) GGUF
+    """
+
+    def __init__(self, model_path: str, mmproj_path: str, n_ctx: int = 4096,
+                 n_gpu_layers: int = -1, max_tokens: int = 128):
+        self.model_name = os.path.basename(model_path)
+        self.model_path = model_path
+        self.mmproj_path = mmproj_path
+        self.n_ctx = n_ctx
+        self.n_gpu_layers = n_gpu_layers  # -1 offloads every layer (Metal / CUDA builds)
+        self.max_tokens = max_tokens
+        self.device = "llama.cpp"
+        self.llm = None
+        self.model_loaded = False
+        # A Llama instance is not thread-safe; calls are serialized
+        self._lock = threading.Lock()
+
+        logger.info(f"🚀 llama.cpp Qwen OCR Engine initialized")
+        logger.info(f"🎯 Model: {self.model_path} (n_gpu_layers={self.n_gpu_layers})")
+
+    def load_model(self) -> bool:
+        """Load the GGUF model and vision projector (once)."""
+        if self.model_loaded:
+            return True
+        with self._lock:
+            if self.model_loaded:
+                return True
+            try:
+                logger.info("📥 Loading GGUF model with llama.cpp...")
+                self.llm = Llama(
+                    model_path=self.model_path,
+                    chat_handler=Qwen25VLChatHandler(clip_model_path=self.mmproj_path, verbose=False),
+                    n_ctx=self.n_ctx,
+                    n_gpu_layers=self.n_gpu_layers,
+                    verbose=False,
+                )
+                self.model_loaded = True
+                logger.info("✅ llama.cpp model ready")
+            except Exception as e:
+                logger.error(f"❌ Failed to load llama.cpp model: {e}")
+            return self.model_loaded
+
+    def shutdown(self):
+        """Free the model."""
+        with self._lock:
+            if self.llm is not None:
+                close = getattr(self.llm, "close", None)
+                if close is not None:
+                    close()
+                self.llm = None
+                self.model_loaded = False
+
+    def extract_text(self, image_path: ImageSource, language: str = "eng") -> Dict[str, Any]:
+        """
+        Extract text from one image
+
+        Args:
+            image_path: Path to image file, raw image bytes, PIL image or decoded array
+            language: Language hint
+
+        Returns:
+            Dictionary with extracted text and metadata
+        """
+        return self.extract_text_batch([image_path], language)[0]
+
+    def extract_text_batch(self, image_paths: List[ImageSource], language: str = "eng") -> List[Dict[str, Any]]:
+        """
+        Extract text from several images, one chat completion each.
+
+        Returns one result dict per input, in input order.
+        """
+        start_time = time.time()
+        if not self.load_model():
+            return [self._create_error_response("llama.cpp model not available", start_time) for _ in image_paths]
+
+        prompt = self._create_ocr_prompt(language)
+        results: List[Dict[str, Any]] = []
+        for image_path in image_paths:
+            try:
+                messages = [{
+                    "role": "user",
+                    "content": [
+                        {"type": "image_url", "image_url": {"url": encode_image_data_url(image_path)}},
+                        {"type": "text", "text": prompt},
+                    ],
+                }]
+                with self._lock:
+                    response = self.llm.create_chat_completion(
+                        messages=messages, max_tokens=self.max_tokens, temperature=0.0
+                    )
+                extracted_text = parse_chat_response(response)
+            except Exception as e:
+                logger.error(f"❌ llama.cpp request failed for {describe_source(image_path)}: {e}")
+                results.append(self._create_error_response(str(e), start_time))
+                continue
+            results.append(self._create_success_response(extracted_text, language, start_time))
+
+        logger.info(f"✅ llama.cpp OCR of {len(image_paths)} images completed in {time.time() - start_time:.2f}s")
+        return results
+
+    def _create_ocr_prompt(self, language: str) -> str:
+        """Create an appropriate OCR prompt."""
+        if language in ["urd", "ara"]:
+            return "What is the text written in this image? Please transcribe all text accurately, including any Arabic or Urdu text."
+        else:
+            return "What is the text written in this image? Please transcribe all text accurately."
+
+    def _create_success_response(self, extracted_text: str, language: str, start_time: float) -> Dict[str, Any]:
+        """Create a standardized success response."""
+        return {
+            "text": extracted_text,
+            "confidence": 90.0,  # High confidence for Qwen
+            "language": language,
+            "engine": "Qwen2.5-VL-3B-Instruct (llama.cpp)",
+            "word_count": len(extracted_text.split()) if extracted_text else 0,
+            "processing_time": time.time() - start_time,
+            "model_name": self.model_name,
+            "device": self.device,
+            "success": True
+        }
+
+    def _create_error_response(self, error_message: str, start_time: float) -> Dict[str, Any]:
+        """Create a standardized error response."""
+        return {
+            "text": "",
+            "confidence": 0.0,
+            "language": "unknown",
+            "engine": "Qwen2.5-VL-3B-Instruct (llama.cpp)",
+            "word_count": 0,
+            "processing_time": time.time() - start_time,
+            "model_name": self.model_name,
+            "device": self.device,
+            "success": False,
+            "error": error_message
+        }
+
+
+# Enabled by setting LLAMACPP_MODEL_PATH and LLAMACPP_MMPROJ_PATH; the model loads with the server's prewarm
+LLAMACPP_MODEL_PATH = os.getenv("LLAMACPP_MODEL_PATH")
+LLAMACPP_MMPROJ_PATH = os.getenv("LLAMACPP_MMPROJ_PATH")
+
+llamacpp_qwen_ocr = (
+    LlamaCppQwenOCR(
+        LLAMACPP_MODEL_PATH,
+        LLAMACPP_MMPROJ_PATH,
+        n_ctx=int(os.getenv("LLAMACPP_N_CTX", "4096")),
+        n_gpu_layers=int(os.getenv("LLAMACPP_GPU_LAYERS", "-1")),
+    )
+    if LLAMACPP_AVAILABLE and LLAMACPP_MODEL_PATH and LLAMACPP_MMPROJ_PATH else None
+)
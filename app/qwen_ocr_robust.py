@@ -3,36 +3,60 @@ Robust Qwen2.5-VL OCR Engine with timeout and graceful fallback
 Handles M1 Pro text generation hanging issue
 """
 
+import asyncio
+import gc
+import json
 import logging
+import os
+import platform
+import shutil
 import time
 import signal
 import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Dict, Any, Optional, Callable
+from typing import Dict, Any, Iterable, Iterator, List, Optional, Callable, Tuple, Union
+
+from .image_io import ImageSource, MAX_IMAGE_SIDE, blank_page, decode_image, letterbox, open_image, describe_source
+from .generation import (
+    BITSANDBYTES_AVAILABLE, CPU_QUANTIZATIONS, QUANTO_AVAILABLE, DeadlineStoppingCriteria, TextProgress,
+    accelerator_dtype, attn_implementation, compile_forward, compile_setting, default_cpu_quantization,
+    empty_device_cache, is_out_of_memory, nf4_load_kwargs, optimize_for_cpu, pick_device, probe_mps,
+    quantize_int8_weights
+)
+from .qwen_inputs import SUPPORTED_LANGUAGES, PromptTokenCache, VisionEmbeddingCache
+from .result_cache import content_hash
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Qwen2.5-VL sees images in 28 px units (14 px patches, merged 2x2)
+PATCH_GRID = 28
+
+# Loaded state shared by every RobustQwenOCR in the process, keyed by requested
+# (model, device, quantization), so a second instance never reloads the weights
+_MODEL_CACHE: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+_SHARED_STATE = ("model", "processor", "device", "model_name", "actual_model_used", "prompt_tokens", "vision_cache")
+
+# Which loading approach worked last time, per model/torch/hardware combination
+LOAD_CACHE_PATH = Path.home() / ".cache" / "qwen_ocr" / "load_cache.json"
+
+# Grow CUDA allocations in place instead of fragmenting into fixed segments
+# (read when CUDA initializes, so it applies as long as it is set before the model loads)
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+
 # Check for dependencies
 try:
     import torch
-    from transformers import AutoProcessor, AutoModelForVision2Seq
+    from transformers import AutoProcessor, AutoModelForVision2Seq, StoppingCriteriaList
     from PIL import Image
     import transformers
 
     # Check transformers version
     logger.info(f"🔧 Transformers version: {transformers.__version__}")
 
-    # Try to import qwen_vl_utils (may not be available in all environments)
-    try:
-        from qwen_vl_utils import process_vision_info
-        QWEN_VL_UTILS_AVAILABLE = True
-        logger.info("✅ qwen_vl_utils available")
-    except ImportError:
-        QWEN_VL_UTILS_AVAILABLE = False
-        logger.warning("⚠️ qwen_vl_utils not available - using fallback approach")
-
     TRANSFORMERS_AVAILABLE = True
     logger.info("✅ All dependencies available")
 except ImportError as e:
@@ -43,13 +67,44 @@ class TimeoutError(Exception):
     """Custom timeout exception."""
     pass
 
+# Extra seconds the SIGALRM backstop allows past the stopping-criterion budget
+HARD_DEADLINE_GRACE = 5
+
+
+@contextmanager
+def _deadline(seconds: float):
+    """
+    Raise TimeoutError in the block after `seconds` via SIGALRM.
+
+    Unlike a stopping criterion this also interrupts a stalled prefill or
+    vision encoder. Signals are only delivered to the main thread, so on
+    other threads (or without SIGALRM) the block runs unguarded.
+    """
+    if not hasattr(signal, "SIGALRM") or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def _expire(signum, frame):
+        raise TimeoutError(f"Text generation exceeded {seconds:.0f}s")
+
+    previous = signal.signal(signal.SIGALRM, _expire)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
 class RobustQwenOCR:
     """
     Robust Qwen2.5-VL OCR Engine with timeout handling
     Gracefully handles M1 Pro text generation hanging
     """
 
-    def __init__(self, model_name: str = "Qwen/Qwen2.5-VL-3B-Instruct", timeout: int = 30):
+    def __init__(self, model_name: str = "Qwen/Qwen2.5-VL-3B-Instruct", timeout: int = 30,
+                 compile_model: Union[bool, str] = False, vision_cache_size: int = 32, quantization: str = "fp32",
+                 kv_cache: Optional[str] = None, device: Optional[str] = None, cleanup_every: int = 0,
+                 fixed_side: Union[int, Iterable[int], None] = None, max_batch_tokens: int = 0):
         # Model compatibility fallback list (Linux-compatible variants)
         # Prioritize Qwen2.5-VL-3B and avoid 7B models
         self.model_candidates = [
@@ -60,12 +115,48 @@ class RobustQwenOCR:
 
         self.model_name = model_name
         self.actual_model_used = None  # Track which model actually loaded
-        self.device = "cpu"  # Force CPU for M1 Pro stability
+        # CUDA, then MPS on Apple Silicon, then CPU; MPS falls back to CPU if its load-time probe fails
+        self.device = device or (pick_device() if TRANSFORMERS_AVAILABLE else "cpu")
         self.timeout = timeout  # Timeout for text generation
+        self.compile_model = compile_model  # torch.compile forward + warm-up at load time
+        # CPU weight format: "fp32", "bf16" (IPEX on x86 when installed) or "int8" (dynamic
+        # quantization; on MPS, optimum-quanto int8 weights when installed)
+        if quantization not in CPU_QUANTIZATIONS:
+            logger.warning(f"⚠️ Unknown quantization {quantization!r}, using fp32")
+            quantization = "fp32"
+        self.quantization = quantization
+        # generate()'s cache_implementation, e.g. "offloaded" to keep the KV cache in host memory.
+        # A compiled forward defaults to "static": fixed KV shapes let it reuse one graph every step
+        # (dropped again if the compiled warm-up fails); an explicit setting is always kept
+        self._static_cache_for_compile = kv_cache is None and bool(compile_model)
+        if self._static_cache_for_compile:
+            kv_cache = "static"
+        self.kv_cache = kv_cache
+        # Letterbox every image to a fixed square on the patch grid (one side, or the smallest
+        # of a ladder of sides that fits it), so requests only ever see a few pixel_values /
+        # image_grid_thw shapes (None keeps the native aspect ratio)
+        self.fixed_sides = self._grid_sides(fixed_side)
+        self.fixed_side = self.fixed_sides[-1] if self.fixed_sides else None
+        # Vision-token budget per padded generate() call in batch OCR (0 = whole batch at once)
+        self.max_batch_tokens = max_batch_tokens
+        # Periodic gc + device cache release, only if memory creeps up over a long run
+        self.cleanup_every = cleanup_every
+        self._requests_since_cleanup = 0
         self.model = None
         self.processor = None
         self.model_loaded = False
         self.memory_issues_detected = False  # Track memory problems
+        self._prompt_texts: Dict[str, str] = {}
+        # Pre-tokenized prompt halves per language (chat-template models only), set at load time
+        self.prompt_tokens: Optional[PromptTokenCache] = None
+        # Vision encoder outputs of recent images (0 disables), set up once the model loads
+        self.vision_cache_size = vision_cache_size
+        self.vision_cache: Optional[VisionEmbeddingCache] = None
+        # prepare_batch() and the GPU thread may both trigger the first load
+        self._load_lock = threading.Lock()
+        # extract_text_async(): parallel preprocessing, one generate() at a time
+        self._prepare_slots = asyncio.Semaphore(os.cpu_count() or 1)
+        self._generate_turn = asyncio.Lock()
 
         # Check available memory
         try:
@@ -89,13 +180,28 @@ class RobustQwenOCR:
             logger.warning(f"⚠️ Memory constraints detected - recommend using PaddleOCR instead")
     
     def load_model(self, progress_callback: Optional[Callable] = None):
-        """Load the Qwen2.5-VL model and processor."""
+        """Load the Qwen2.5-VL model and processor (once, even from several threads)."""
+        if self.model_loaded:
+            return True
+        with self._load_lock:
+            return self._load_model(progress_callback)
+
+    def _load_model(self, progress_callback: Optional[Callable] = None):
         if self.model_loaded:
             return True
             
         if not TRANSFORMERS_AVAILABLE:
             logger.error("❌ Transformers not available")
             return False
+
+        cache_key = (self.model_name, self.device, self.quantization)
+        if cache_key in _MODEL_CACHE:
+            # Another instance already loaded this model in this process
+            for name, value in _MODEL_CACHE[cache_key].items():
+                setattr(self, name, value)
+            self.model_loaded = True
+            logger.info(f"♻️ Reusing loaded model: {self.actual_model_used}")
+            return True
         
         # Try loading different models for compatibility
         model_loaded = False
@@ -120,6 +226,9 @@ class RobustQwenOCR:
                 )
                 logger.info(f"✅ Processor loaded for {model_candidate}")
 
+                # Left-pad so batched prompts all end right before the generated tokens
+                test_processor.tokenizer.padding_side = "left"
+
                 # If processor loads successfully, try the model
                 self.model_name = model_candidate
                 self.actual_model_used = model_candidate
@@ -135,6 +244,16 @@ class RobustQwenOCR:
 
         logger.info(f"✅ Using compatible model: {self.actual_model_used}")
 
+        if self.fixed_side:
+            # Images already arrive on the patch grid; skip the processor's own resize
+            self.processor.image_processor.do_resize = False
+
+        if getattr(self.processor, "chat_template", None):
+            # Template and tokenize each language's prompt once; requests then only run the image processor
+            prompt_tokens = PromptTokenCache(self.processor, self._create_ocr_prompt)
+            if prompt_tokens.warm(SUPPORTED_LANGUAGES, self._prepare_image(blank_page(64))):
+                self.prompt_tokens = prompt_tokens
+
         try:
             # Load model with multiple fallback approaches for compatibility
             if progress_callback:
@@ -142,31 +261,13 @@ class RobustQwenOCR:
 
             model_loaded = False
 
-            # Try different loading approaches for maximum compatibility
-            loading_approaches = [
-                {
-                    "name": "AutoModelForVision2Seq with float32",
-                    "kwargs": {
-                        "torch_dtype": torch.float32,
-                        "trust_remote_code": True,
-                        "low_cpu_mem_usage": True
-                    }
-                },
-                {
-                    "name": "AutoModelForVision2Seq with float16",
-                    "kwargs": {
-                        "torch_dtype": torch.float16,
-                        "trust_remote_code": True,
-                        "low_cpu_mem_usage": True
-                    }
-                },
-                {
-                    "name": "AutoModelForVision2Seq basic",
-                    "kwargs": {
-                        "trust_remote_code": True
-                    }
-                }
-            ]
+            # Approaches in order of preference for this device; later ones are
+            # fallbacks for stacks that reject an attention backend or dtype
+            loading_approaches = self._loading_approaches()
+
+            # Jump straight to the approach that worked last time on this setup
+            winner = self._read_load_cache().get(self._load_cache_key())
+            loading_approaches.sort(key=lambda approach: approach["name"] != winner)
 
             for approach in loading_approaches:
                 if model_loaded:
@@ -176,20 +277,59 @@ class RobustQwenOCR:
                     self.model = AutoModelForVision2Seq.from_pretrained(
                         self.model_name,
                         **approach['kwargs']
-                    ).to(self.device)
+                    )
+                    if "device_map" not in approach["kwargs"]:
+                        # Quantized models are placed by device_map and can't be moved
+                        self.model = self.model.to(self.device)
                     logger.info(f"✅ Model loaded with {approach['name']}")
                     model_loaded = True
+                    if approach["name"] != winner:
+                        self._write_load_cache(approach["name"])
                 except Exception as e:
                     logger.warning(f"⚠️ {approach['name']} failed: {e}")
+                    # Free the partial load before the next approach allocates its own weights
+                    self.model = None
+                    gc.collect()
+                    empty_device_cache(self.device)
+                    if is_out_of_memory(e):
+                        # Another full allocation would only push peak memory higher; give up instead
+                        self.memory_issues_detected = True
+                        raise
 
             if not model_loaded:
                 raise Exception("Failed to load model with any approach")
 
             logger.info("✅ Model loaded successfully")
+
+            self.model, self.device = probe_mps(self.model, self.device, self._probe)
+
+            if self.device == "cpu" and self.quantization != "fp32":
+                self.model = optimize_for_cpu(self.model, self.quantization)
+            elif self.device == "mps" and self.quantization == "int8":
+                if QUANTO_AVAILABLE:
+                    self.model = quantize_int8_weights(self.model)
+                else:
+                    logger.warning("⚠️ int8 on MPS needs optimum-quanto - keeping half-precision weights")
+
+            if torch.cuda.is_available():
+                # Let cuDNN pick the fastest kernels for the vision patch-embedding conv
+                torch.backends.cudnn.benchmark = True
+
+            vision_cache = VisionEmbeddingCache(self.model, self.vision_cache_size)
+            if vision_cache.supported:
+                self.vision_cache = vision_cache
+                logger.info(f"🧠 Caching vision encoder output for {self.vision_cache_size} images")
+
+            if self.compile_model and hasattr(torch, "compile"):
+                # Fixed image sides keep shapes static, so let torch specialize on them
+                compile_forward(self.model, self.device, self.compile_model,
+                                dynamic=None if self.fixed_side else True)
+                self._warm_up()
             
             if progress_callback:
                 progress_callback("Model ready for inference", 60)
             
+            _MODEL_CACHE[cache_key] = {name: getattr(self, name) for name in _SHARED_STATE}
             self.model_loaded = True
             return True
             
@@ -197,40 +337,284 @@ class RobustQwenOCR:
             logger.error(f"❌ Failed to load model: {e}")
             return False
     
-    def _generate_with_timeout(self, inputs, generation_kwargs):
-        """Generate text with timeout handling."""
-        result = {"success": False, "output": None, "error": None}
-        
-        def target():
-            try:
-                with torch.no_grad():
-                    generated_ids = self.model.generate(**inputs, **generation_kwargs)
-                    result["output"] = generated_ids
-                    result["success"] = True
-            except Exception as e:
-                result["error"] = str(e)
-        
-        # Start generation in a separate thread
-        thread = threading.Thread(target=target)
-        thread.daemon = True
-        thread.start()
-        
-        # Wait for completion or timeout
-        thread.join(timeout=self.timeout)
-        
-        if thread.is_alive():
-            # Generation is still running - timeout occurred
-            logger.warning(f"⏰ Text generation timed out after {self.timeout}s")
-            result["error"] = f"Text generation timed out after {self.timeout}s"
-            result["success"] = False
-            # Note: We can't actually kill the thread, but we can return early
-        
-        return result
-    
-    def extract_text(self, image_path: str, language: str = "eng", 
+    def _loading_approaches(self) -> List[Dict[str, Any]]:
+        """
+        from_pretrained() kwargs to try, best first, chosen from what this machine supports.
+
+        Approaches that can't work here (half precision on CPU, bf16 without a
+        CPU bf16 setting) are left out rather than tried and failed, since
+        each failed attempt can map the full weights before raising.
+        """
+        base = {"trust_remote_code": True, "low_cpu_mem_usage": True}
+        approaches = []
+        if self.device != "cpu":
+            # GPUs run half precision (FlashAttention-2 on Ampere+ when installed, else SDPA);
+            # SDPA and float32 approaches follow if it fails
+            half_dtype = accelerator_dtype(self.device)
+            if self.device == "cuda" and BITSANDBYTES_AVAILABLE:
+                approaches.append({
+                    "name": "NF4 4-bit via bitsandbytes",
+                    "kwargs": {
+                        **base, **nf4_load_kwargs(), "torch_dtype": half_dtype,
+                        "attn_implementation": attn_implementation(self.device, half_dtype)
+                    }
+                })
+            for attention in dict.fromkeys((attn_implementation(self.device, half_dtype), "sdpa")):
+                approaches.append({
+                    "name": f"AutoModelForVision2Seq with {half_dtype} + {attention} on {self.device}",
+                    "kwargs": {**base, "torch_dtype": half_dtype, "attn_implementation": attention}
+                })
+        elif self.quantization == "bf16":
+            # Half the weight bytes per decode step; fp32 approaches follow if it fails
+            approaches.append({
+                "name": "AutoModelForVision2Seq with bfloat16 + SDPA",
+                "kwargs": {**base, "torch_dtype": torch.bfloat16, "attn_implementation": "sdpa"}
+            })
+        approaches += [
+            {
+                # Fused scaled-dot-product attention; remote-code models without it fall through
+                "name": "AutoModelForVision2Seq with float32 + SDPA",
+                "kwargs": {**base, "torch_dtype": torch.float32, "attn_implementation": "sdpa"}
+            },
+            {
+                # Plain PyTorch attention for older stacks without fused kernels
+                "name": "AutoModelForVision2Seq with float32 + eager attention",
+                "kwargs": {**base, "torch_dtype": torch.float32, "attn_implementation": "eager"}
+            },
+        ]
+        return approaches
+
+    def share_memory(self) -> bool:
+        """
+        Move the loaded CPU weights into shared memory.
+
+        Call before forking workers (gunicorn preload_app): every child then
+        maps the same physical pages, where plain copy-on-write would copy
+        them as soon as they are touched. Children inherit model_loaded and
+        never load their own copy.
+
+        The weights go to /dev/shm, so they are left in place when it is too
+        small to hold them (Docker's default is 64 MB).
+        """
+        if not self.model_loaded or self.device != "cpu":
+            return False
+        weight_bytes = sum(t.numel() * t.element_size() for t in self.model.state_dict().values())
+        try:
+            shm_free = shutil.disk_usage("/dev/shm").free
+        except OSError:
+            shm_free = 0
+        if shm_free < weight_bytes:
+            logger.warning(
+                f"⚠️ /dev/shm has {shm_free / 1e9:.1f} GB free, model needs {weight_bytes / 1e9:.1f} GB - "
+                "not sharing weights (raise the container's shm size)"
+            )
+            return False
+        self.model.share_memory()
+        logger.info("🤝 Model weights moved to shared memory")
+        return True
+
+    def _load_cache_key(self) -> str:
+        """Loading outcomes are deterministic per model, torch build, machine and weight setup."""
+        return "|".join((self.model_name, torch.__version__, platform.machine(), self.device, self.quantization))
+
+    def _read_load_cache(self) -> Dict[str, str]:
+        try:
+            return json.loads(LOAD_CACHE_PATH.read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def _write_load_cache(self, approach_name: str):
+        """Remember the winning approach; a read-only home directory just means no cache."""
+        cache = self._read_load_cache()
+        cache[self._load_cache_key()] = approach_name
+        try:
+            LOAD_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+            LOAD_CACHE_PATH.write_text(json.dumps(cache, indent=2))
+        except OSError as e:
+            logger.info(f"💾 Could not save load cache: {e}")
+
+    def _probe(self):
+        """One-token generate() on a blank page, used to verify the device at load time."""
+        inputs = self._build_inputs([self._prepare_image(blank_page(64))], "eng")
+        self.model.generate(**inputs, **{**self._generation_kwargs(), "max_new_tokens": 1})
+
+    def _warm_up(self):
+        """Run one short generate() so compilation happens before the first request."""
+        logger.info("🔥 Warming up compiled model (one-time compile)...")
+        start_time = time.time()
+        try:
+            # With fixed sides, compile each image shape now rather than on a request
+            for side in self.fixed_sides or (512,):
+                inputs = self._build_inputs([self._prepare_image(blank_page(side))], "eng")
+                with torch.inference_mode():
+                    self.model.generate(**inputs, **{**self._generation_kwargs(), "max_new_tokens": 4})
+        except Exception as e:
+            # Fall back to the eager forward rather than failing the load
+            logger.warning(f"⚠️ Compiled warm-up failed ({e}), using eager forward")
+            del self.model.forward
+            if self._static_cache_for_compile:
+                # The static cache was only chosen for the compiled graph and may be what failed
+                logger.warning("⚠️ Dropping the compile-default static KV cache")
+                self.kv_cache = None
+            return
+        logger.info(f"✅ Warm-up finished in {time.time() - start_time:.1f}s")
+
+    def _generate(self, inputs, generation_kwargs) -> Tuple[Any, bool]:
+        """
+        Run generate() on the calling thread under the engine's time budget.
+
+        Returns the generated ids and whether the budget cut generation short
+        (in which case the ids hold the text produced so far). On the main
+        thread a SIGALRM backstop raises TimeoutError if generate() overruns
+        the budget by more than HARD_DEADLINE_GRACE seconds.
+        """
+        deadline = DeadlineStoppingCriteria(self.timeout)
+        with _deadline(self.timeout + HARD_DEADLINE_GRACE), torch.inference_mode():
+            generated_ids = self.model.generate(
+                **inputs, **generation_kwargs, stopping_criteria=StoppingCriteriaList([deadline])
+            )
+        if deadline.expired:
+            logger.warning(f"⏰ Text generation stopped at the {self.timeout}s budget")
+        return generated_ids, deadline.expired
+
+    @staticmethod
+    def _grid_sides(fixed_side: Union[int, Iterable[int], None]) -> Tuple[int, ...]:
+        """Fixed square sides, rounded down to the patch grid and sorted smallest first."""
+        if not fixed_side:
+            return ()
+        sides = set()
+        for side in ([fixed_side] if isinstance(fixed_side, int) else fixed_side):
+            if side % PATCH_GRID:
+                logger.warning(f"⚠️ Fixed image side {side} rounded down to {side - side % PATCH_GRID} (multiple of {PATCH_GRID})")
+                side -= side % PATCH_GRID
+            if side > 0:
+                sides.add(side)
+        return tuple(sorted(sides))
+
+    def _prepare_image(self, image_path: ImageSource) -> "Image.Image":
+        """Load an input image and downscale it for memory-safe inference."""
+        logger.info(f"📷 Processing image: {describe_source(image_path)}")
+
+        # Decode + resize in one pass (libvips when installed); uploads the server
+        # already decoded are at most MAX_IMAGE_SIDE and pass through unchanged
+        image = decode_image(image_path, self.fixed_side or MAX_IMAGE_SIDE)
+        if self.fixed_side:
+            longest = max(image.shape[:2])
+            image = letterbox(image, next(side for side in self.fixed_sides if side >= longest))
+        image = open_image(image)
+        logger.info(f"✅ Image ready: {image.size}")
+        return image
+
+    def _build_inputs(self, images: List["Image.Image"], language: str):
+        """Build one padded processor batch for the given (already decoded) images."""
+        if self.prompt_tokens is not None:
+            # Cached prompt ids with the image-pad run spliced in; no templating or tokenizing
+            return self._to_model(self.prompt_tokens.build(images, language))
+
+        # The processor takes the PIL images directly; the chat template is
+        # only needed for the text side, and is the same for every image
+        prompt_text = self._prompt_text(language)
+        return self._to_model(self.processor(
+            text=[prompt_text] * len(images),
+            images=images,
+            padding=True,
+            return_tensors="pt",
+        ))
+
+    def _to_model(self, inputs):
+        """
+        Move processor outputs to the model's device, pixel values already in a half-precision model's dtype.
+
+        On CPU nothing is copied. On CUDA each tensor is pinned and sent with
+        non_blocking=True, so this thread can move on while the copy runs;
+        the stream still orders it before generate() reads the inputs.
+        """
+        dtype = getattr(self.model, "dtype", None)
+        cast = dtype in (torch.bfloat16, torch.float16)
+        for key, value in inputs.items():
+            if not torch.is_tensor(value):
+                continue
+            if cast and value.is_floating_point():
+                # Cast on the host so only half the pixel bytes cross the bus; input ids stay integers
+                value = value.to(dtype)
+            if self.device == "cuda":
+                value = value.pin_memory().to(self.device, non_blocking=True)
+            elif self.device != "cpu":
+                value = value.to(self.device)
+            inputs[key] = value
+        return inputs
+
+    def _prompt_text(self, language: str) -> str:
+        """Chat-templated prompt with one image placeholder, built once per language."""
+        if language not in self._prompt_texts:
+            prompt = self._create_ocr_prompt(language)
+            if getattr(self.processor, "chat_template", None):
+                messages = [{
+                    "role": "user",
+                    "content": [
+                        {"type": "image"},
+                        {"type": "text", "text": prompt},
+                    ],
+                }]
+                prompt = self.processor.apply_chat_template(
+                    messages, tokenize=False, add_generation_prompt=True
+                )
+            self._prompt_texts[language] = prompt
+        return self._prompt_texts[language]
+
+    def _generation_kwargs(self) -> Dict[str, Any]:
+        """Ultra-conservative generation settings for cloud memory limits."""
+        kwargs = {
+            "max_new_tokens": 32,   # Reduced further to minimize memory
+            "do_sample": False,     # Deterministic (greedy) generation
+            "pad_token_id": self.processor.tokenizer.eos_token_id,
+            "eos_token_id": self.processor.tokenizer.eos_token_id,
+            # KV cache: each step attends from one new token instead of re-running the
+            # whole prefix; for a few hundred tokens it costs only a few MB
+            "use_cache": True,
+        }
+        if self.kv_cache:
+            kwargs["cache_implementation"] = self.kv_cache
+        return kwargs
+
+    def _decode(self, generated_ids, inputs) -> List[str]:
+        """Decode generated ids into one stripped string per batch row."""
+        # Trim input tokens (prompts are left-padded to a common length)
+        input_token_len = inputs["input_ids"].shape[1]
+        # One device->host copy of just the new tokens; batch_decode would otherwise copy row by row
+        response_token_ids = generated_ids[:, input_token_len:].cpu()
+
+        # No tokenization-space cleanup: it would rewrite OCR text such as " ," and " 's"
+        outputs = self.processor.batch_decode(
+            response_token_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False
+        )
+        return [output.strip() for output in outputs]
+
+    def _create_success_response(self, extracted_text: str, language: str, start_time: float,
+                                 timed_out: bool = False) -> Dict[str, Any]:
+        """Create a standardized success response (partial text when the time budget ran out)."""
+        response = {
+            "text": extracted_text,
+            "confidence": 90.0,  # High confidence for Qwen
+            "language": language,
+            "engine": "Qwen2.5-VL-3B-Instruct (Robust)",
+            "word_count": len(extracted_text.split()) if extracted_text else 0,
+            "processing_time": time.time() - start_time,
+            "model_name": self.model_name,
+            "device": self.device,
+            "success": True,
+            "timeout_used": self.timeout
+        }
+        if timed_out:
+            response["timeout_occurred"] = True
+        return response
+
+    def extract_text(self, image_path: ImageSource, language: str = "eng", 
                     progress_callback: Optional[Callable] = None) -> Dict[str, Any]:
         """
         Extract text from image using Qwen2.5-VL with timeout protection
+
+        image_path may be a file path, raw image bytes or a PIL image.
         """
         start_time = time.time()
         
@@ -246,149 +630,249 @@ class RobustQwenOCR:
             # Process image
             if progress_callback:
                 progress_callback("Processing image...", 70)
-            
-            logger.info(f"📷 Processing image: {image_path}")
 
             # Load image with memory optimization
             try:
-                image = Image.open(image_path).convert("RGB")
-                original_size = image.size
-                logger.info(f"✅ Image loaded: {original_size}")
-
-                # Resize large images to reduce memory usage (critical for cloud deployment)
-                max_dimension = 1024  # Reduce from default to save memory
-                if max(image.size) > max_dimension:
-                    # Calculate new size maintaining aspect ratio
-                    ratio = max_dimension / max(image.size)
-                    new_size = tuple(int(dim * ratio) for dim in image.size)
-                    image = image.resize(new_size, Image.LANCZOS)
-                    logger.info(f"🔄 Image resized from {original_size} to {image.size} for memory optimization")
-
+                image = self._prepare_image(image_path)
             except Exception as e:
                 return self._create_error_response(f"Failed to load image: {e}", start_time)
             
-            # Create message format and process inputs with fallback approaches
-            if QWEN_VL_UTILS_AVAILABLE:
-                # Use qwen_vl_utils approach (preferred)
-                logger.info("🔄 Using qwen_vl_utils approach")
-                messages = [
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "image", "image": image_path},
-                            {"type": "text", "text": self._create_ocr_prompt(language)},
-                        ],
-                    }
-                ]
-
-                # Apply chat template
-                text_prompt = self.processor.apply_chat_template(
-                    messages, tokenize=False, add_generation_prompt=True
-                )
-
-                # Process vision info
-                image_inputs, video_inputs = process_vision_info(messages)
-
-                # Process inputs
-                inputs = self.processor(
-                    text=[text_prompt],
-                    images=image_inputs,
-                    videos=video_inputs,
-                    padding=True,
-                    return_tensors="pt",
-                ).to(self.device)
-            else:
-                # Fallback approach without qwen_vl_utils
-                logger.info("🔄 Using fallback approach (no qwen_vl_utils)")
-                prompt = self._create_ocr_prompt(language)
-
-                # Simple approach - process image and text directly
-                inputs = self.processor(
-                    text=prompt,
-                    images=image,
-                    return_tensors="pt",
-                    padding=True
-                ).to(self.device)
+            inputs = self._build_inputs([image], language)
             
             if progress_callback:
-                progress_callback("Generating text (with timeout protection)...", 80)
+                progress_callback("Generating text (with time budget)...", 80)
             
-            # Memory cleanup before generation
-            import gc
-            gc.collect()
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-
-            # Ultra-conservative generation for cloud memory limits
-            generation_kwargs = {
-                "max_new_tokens": 32,   # Reduced further to minimize memory
-                "min_new_tokens": 1,
-                "do_sample": False,     # Deterministic generation
-                "num_beams": 1,         # Single beam to save memory
-                "pad_token_id": self.processor.tokenizer.eos_token_id,
-                "eos_token_id": self.processor.tokenizer.eos_token_id,
-                "use_cache": False,     # Disable cache to save memory
-                "output_attentions": False,  # Disable attention outputs
-                "output_hidden_states": False,  # Disable hidden states
-            }
-
-            # Generate with timeout protection
+            generation_kwargs = self._generation_kwargs()
+            if progress_callback:
+                # Report the text as it is decoded instead of only once generation ends
+                generation_kwargs["streamer"] = TextProgress(
+                    self.processor.tokenizer, progress_callback, generation_kwargs["max_new_tokens"]
+                )
+
+            # Generate within the time budget
             logger.info(f"🎯 Generating text (timeout: {self.timeout}s)...")
-            logger.info(f"💾 Memory optimization: max_tokens={generation_kwargs['max_new_tokens']}, cache=False")
-            
-            generation_result = self._generate_with_timeout(inputs, generation_kwargs)
+            logger.info(f"💾 Generation: max_tokens={generation_kwargs['max_new_tokens']}, kv_cache={self.kv_cache or 'dynamic'}")
             
-            if not generation_result["success"]:
-                error_msg = generation_result.get("error", "Generation failed")
-                logger.error(f"❌ Generation failed: {error_msg}")
-                return self._create_timeout_response(error_msg, start_time)
+            generated_ids, timed_out = self._generate(
+                self._encode_vision(inputs, self._vision_cache_keys([image])), generation_kwargs
+            )
             
             # Decode output
             logger.info("📝 Decoding output...")
-            generated_ids = generation_result["output"]
-            
-            # Trim input tokens
-            input_token_len = inputs["input_ids"].shape[1]
-            response_token_ids = generated_ids[:, input_token_len:]
-            
-            # Decode
-            output = self.processor.batch_decode(
-                response_token_ids, skip_special_tokens=True
-            )[0]
-            
-            extracted_text = output.strip()
-            processing_time = time.time() - start_time
+            extracted_text = self._decode(generated_ids, inputs)[0]
+            result = self._create_success_response(extracted_text, language, start_time, timed_out)
 
-            # Clean up memory to prevent accumulation
-            del generated_ids, response_token_ids, inputs, output
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-            import gc
-            gc.collect()
+            del generated_ids, inputs
+            self._count_requests(1)
 
             if progress_callback:
                 progress_callback("OCR completed!", 100)
             
-            logger.info(f"✅ OCR completed in {processing_time:.2f}s")
+            logger.info(f"✅ OCR completed in {result['processing_time']:.2f}s")
             logger.info(f"📄 Extracted text length: {len(extracted_text)} characters")
             
-            return {
-                "text": extracted_text,
-                "confidence": 90.0,  # High confidence for Qwen
-                "language": language,
-                "engine": "Qwen2.5-VL-3B-Instruct (Robust)",
-                "word_count": len(extracted_text.split()) if extracted_text else 0,
-                "processing_time": processing_time,
-                "model_name": self.model_name,
-                "device": self.device,
-                "success": True,
-                "timeout_used": self.timeout
-            }
+            return result
             
+        except TimeoutError as e:
+            logger.warning(f"⏰ {e}")
+            return self._create_timeout_response(str(e), start_time)
         except Exception as e:
             logger.error(f"❌ OCR failed: {e}")
             return self._create_error_response(str(e), start_time)
-    
+
+    def extract_text_batch(self, image_paths: List[ImageSource], language: str = "eng",
+                           max_batch_tokens: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Extract text from several images with padded, batched generate() calls.
+
+        Images that fail to load get an error response; the rest are padded
+        into one batch, or into several when their vision tokens exceed
+        max_batch_tokens (default: the engine's setting, 0 = no limit).
+        Returns one result dict per input, in input order.
+        """
+        return self.generate_batch(self.prepare_batch(image_paths, language, max_batch_tokens))
+
+    async def extract_text_async(self, image_path: ImageSource, language: str = "eng") -> Dict[str, Any]:
+        """
+        Extract text from one image without blocking the event loop.
+
+        Preprocessing runs in worker threads (at most one per CPU) while
+        generate() calls take turns, so with many concurrent callers image
+        N+1 is decoded and tokenized while image N generates.
+        """
+        async with self._prepare_slots:
+            batch = await asyncio.to_thread(self.prepare_batch, [image_path], language)
+        async with self._generate_turn:
+            results = await asyncio.to_thread(self.generate_batch, batch)
+        return results[0]
+
+    def extract_text_stream(self, image_paths: Iterable[ImageSource], language: str = "eng") -> Iterator[Dict[str, Any]]:
+        """
+        Extract text from images one after another, yielding each result in order.
+
+        While image N generates on the calling thread, image N+1 is decoded
+        and tokenized on a helper thread (PIL and the fast tokenizer release
+        the GIL), so back-to-back OCR does not wait on preprocessing.
+        """
+        paths = iter(image_paths)
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="qwen-prepare") as pool:
+            def prepare_next():
+                image_path = next(paths, None)
+                return None if image_path is None else pool.submit(self.prepare_batch, [image_path], language)
+
+            upcoming = prepare_next()
+            while upcoming is not None:
+                batch = upcoming.result()
+                upcoming = prepare_next()
+                yield self.generate_batch(batch)[0]
+
+    def prepare_batch(self, image_paths: List[ImageSource], language: str = "eng",
+                      max_batch_tokens: Optional[int] = None) -> Dict[str, Any]:
+        """
+        CPU half of extract_text_batch: load the images and build processor inputs.
+
+        Safe to run on another thread while generate_batch() works on the
+        previous batch, so preprocessing overlaps generation. With a token
+        budget the images are split into several padded sub-batches.
+        """
+        start_time = time.time()
+        batch = {
+            "language": language,
+            "start_time": start_time,
+            "results": [None] * len(image_paths),
+            "chunks": [],
+        }
+        results = batch["results"]
+
+        try:
+            if not self.model_loaded and not self.load_model():
+                batch["results"] = [self._create_error_response("Failed to load model", start_time) for _ in image_paths]
+                return batch
+
+            images, indices = [], []
+            for index, image_path in enumerate(image_paths):
+                try:
+                    images.append(self._prepare_image(image_path))
+                    indices.append(index)
+                except Exception as e:
+                    results[index] = self._create_error_response(f"Failed to load image: {e}", start_time)
+
+            if max_batch_tokens is None:
+                max_batch_tokens = self.max_batch_tokens
+            for group in self._pack_by_tokens(images, max_batch_tokens):
+                chunk_images = [images[position] for position in group]
+                batch["chunks"].append({
+                    "indices": [indices[position] for position in group],
+                    "inputs": self._build_inputs(chunk_images, language),
+                    "cache_keys": self._vision_cache_keys(chunk_images),
+                })
+
+        except Exception as e:
+            logger.error(f"❌ Batch preparation failed: {e}")
+            batch["results"] = [result or self._create_error_response(str(e), start_time) for result in results]
+            batch["chunks"] = []
+        return batch
+
+    def generate_batch(self, batch: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """GPU half of extract_text_batch: one generate() call per sub-batch of a prepare_batch() result."""
+        start_time = batch["start_time"]
+        results: List[Optional[Dict[str, Any]]] = batch["results"]
+        chunks = batch.pop("chunks", [])
+
+        try:
+            while chunks:
+                chunk = chunks.pop(0)
+                inputs, chunk_indices = chunk["inputs"], chunk["indices"]
+                logger.info(f"🎯 Generating text for batch of {len(chunk_indices)} (timeout: {self.timeout}s)...")
+                generated_ids, timed_out = self._generate(
+                    self._encode_vision(inputs, chunk["cache_keys"]), self._generation_kwargs()
+                )
+
+                texts = self._decode(generated_ids, inputs)
+                for index, extracted_text in zip(chunk_indices, texts):
+                    results[index] = self._create_success_response(
+                        extracted_text, batch["language"], start_time, timed_out
+                    )
+
+                del chunk, inputs, generated_ids
+                self._count_requests(len(chunk_indices))
+
+            logger.info(f"✅ Batch OCR of {len(results)} images completed in {time.time() - start_time:.2f}s")
+            return results
+
+        except TimeoutError as e:
+            logger.warning(f"⏰ {e}")
+            return [result or self._create_timeout_response(str(e), start_time) for result in results]
+        except Exception as e:
+            logger.error(f"❌ Batch OCR failed: {e}")
+            return [result or self._create_error_response(str(e), start_time) for result in results]
+
+    def _pack_by_tokens(self, images: List["Image.Image"], max_batch_tokens: int) -> List[List[int]]:
+        """
+        Greedily group image positions so each padded sub-batch stays within max_batch_tokens.
+
+        A padded batch costs (size x its largest image) tokens, so images are
+        visited smallest first and similar sizes end up together. 0 = one batch.
+        """
+        if not images:
+            return []
+        if not max_batch_tokens:
+            return [list(range(len(images)))]
+
+        # One merged vision token per 28x28 patch of the (already resized) image
+        tokens = [
+            max(1, round(image.width / PATCH_GRID)) * max(1, round(image.height / PATCH_GRID))
+            for image in images
+        ]
+        groups: List[List[int]] = []
+        group: List[int] = []
+        largest = 0
+        for position in sorted(range(len(images)), key=tokens.__getitem__):
+            size = tokens[position]
+            if group and (len(group) + 1) * max(largest, size) > max_batch_tokens:
+                groups.append(group)
+                group, largest = [], 0
+            group.append(position)
+            largest = max(largest, size)
+        groups.append(group)
+        return groups
+
+    def _count_requests(self, count: int):
+        """
+        Run a full gc + allocator release every cleanup_every images (0 = never).
+
+        Doing this per request walks every Python object and hands the
+        caching allocator's blocks back only to reallocate them next call.
+        """
+        if not self.cleanup_every:
+            return
+        self._requests_since_cleanup += count
+        if self._requests_since_cleanup >= self.cleanup_every:
+            self._requests_since_cleanup = 0
+            gc.collect()
+            empty_device_cache(self.device)
+
+    def _vision_cache_keys(self, images: List["Image.Image"]) -> Optional[List]:
+        """Vision cache keys for prepared images (their pixel content and size), or None without a cache."""
+        if self.vision_cache is None:
+            return None
+        return [(content_hash(image.tobytes()), image.size) for image in images]
+
+    def _encode_vision(self, inputs, cache_keys: Optional[List]) -> Dict[str, Any]:
+        """
+        Swap pixel_values for cached/precomputed vision embeddings when possible,
+        so generate() only runs the language model.
+        """
+        if self.vision_cache is None or cache_keys is None:
+            return inputs
+        try:
+            with torch.inference_mode():
+                return self.vision_cache.embed(inputs, cache_keys)
+        except Exception as e:
+            logger.warning(f"⚠️ Vision embedding cache disabled ({e}), passing pixel values to generate()")
+            self.vision_cache = None
+            return inputs
+
     def _create_ocr_prompt(self, language: str) -> str:
         """Create an appropriate OCR prompt."""
         if language in ["urd", "ara"]:
@@ -411,24 +895,24 @@ class RobustQwenOCR:
             "error": error_message,
             "timeout_used": self.timeout
         }
-    
+
     def _create_timeout_response(self, error_message: str, start_time: float) -> Dict[str, Any]:
         """Create a timeout-specific response."""
-        return {
-            "text": "",
-            "confidence": 0.0,
-            "language": "unknown",
-            "engine": "Qwen2.5-VL-3B-Instruct (Timeout)",
-            "word_count": 0,
-            "processing_time": time.time() - start_time,
-            "model_name": self.model_name,
-            "device": self.device,
-            "success": False,
-            "error": error_message,
-            "timeout_occurred": True,
-            "timeout_used": self.timeout,
-            "fallback_recommended": True
-        }
-
-# Create global instance with 30-second timeout
-robust_qwen_ocr = RobustQwenOCR(timeout=30) if TRANSFORMERS_AVAILABLE else None
+        response = self._create_error_response(error_message, start_time)
+        response["engine"] = "Qwen2.5-VL-3B-Instruct (Timeout)"
+        response["timeout_occurred"] = True
+        response["fallback_recommended"] = True
+        return response
+
+# Create global instance; its generation budget is the server's QWEN_TIMEOUT (30s by default)
+robust_qwen_ocr = RobustQwenOCR(
+    timeout=float(os.getenv("QWEN_TIMEOUT", "30")),
+    compile_model=compile_setting(os.getenv("QWEN_TORCH_COMPILE", "0")),
+    vision_cache_size=int(os.getenv("QWEN_VISION_CACHE_SIZE", "32")),
+    quantization=os.getenv("QWEN_CPU_QUANTIZATION") or default_cpu_quantization(),
+    kv_cache=os.getenv("QWEN_KV_CACHE") or None,
+    device=os.getenv("QWEN_DEVICE") or None,
+    cleanup_every=int(os.getenv("QWEN_CLEANUP_EVERY", "0")),
+    fixed_side=[int(side) for side in os.getenv("QWEN_FIXED_SIDE", "").split(",") if side.strip()],
+    max_batch_tokens=int(os.getenv("QWEN_MAX_BATCH_TOKENS", "0"))
+) if TRANSFORMERS_AVAILABLE else None
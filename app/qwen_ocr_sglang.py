@@ -0,0 +1,188 @@
+"""
+Qwen2.5-VL OCR Engine backed by an SGLang runtime
+Holds the model in a persistent SGLang server process, so generation gets
+continuous batching, a paged KV cache and CUDA graphs instead of HF generate()
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import Dict, Any, List, Optional
+
+from .image_io import ImageSource, describe_source, encode_image_bytes
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Check for dependencies
+try:
+    import sglang as sgl
+    SGLANG_AVAILABLE = True
+except ImportError:
+    SGLANG_AVAILABLE = False
+    logger.info("sglang not available - SGLang backend disabled")
+
+
+if SGLANG_AVAILABLE:
+    @sgl.function
+    def ocr_program(s, image, prompt, max_tokens):
+        """One image + prompt in, transcription out."""
+        s += sgl.user(sgl.image(image) + prompt)
+        s += sgl.assistant(sgl.gen("answer", max_tokens=max_tokens, temperature=0.0))
+
+
+class SGLangQwenOCR:
+    """
+    Qwen2.5-VL OCR Engine running on an in-process SGLang runtime
+    The runtime (a separate server process) is launched on first use
+    """
+
+    def __init__(self, model_path: str = "Qwen/Qwen2.5-VL-3B-Instruct", tp_size: int = 1,
+                 max_tokens: int = 128, mem_fraction_static: Optional[float] = None):
+        self.model_name = model_path
+        self.tp_size = tp_size
+        self.max_tokens = max_tokens
+        self.mem_fraction_static = mem_fraction_static
+        self.device = "sglang"
+        self.runtime = None
+        self.model_loaded = False
+        self._load_lock = threading.Lock()
+
+        logger.info(f"🚀 SGLang Qwen OCR Engine initialized")
+        logger.info(f"🎯 Model: {self.model_name} (tp_size={self.tp_size})")
+
+    def load_model(self) -> bool:
+        """Launch the SGLang runtime (once)."""
+        if self.model_loaded:
+            return True
+        with self._load_lock:
+            if self.model_loaded:
+                return True
+            try:
+                logger.info("📥 Launching SGLang runtime...")
+                runtime_kwargs = {"model_path": self.model_name, "tp_size": self.tp_size}
+                if self.mem_fraction_static is not None:
+                    runtime_kwargs["mem_fraction_static"] = self.mem_fraction_static
+                self.runtime = sgl.Runtime(**runtime_kwargs)
+                self.model_loaded = True
+                logger.info("✅ SGLang runtime ready")
+            except Exception as e:
+                logger.error(f"❌ Failed to launch SGLang runtime: {e}")
+            return self.model_loaded
+
+    def shutdown(self):
+        """Stop the SGLang runtime process."""
+        if self.runtime is not None:
+            self.runtime.shutdown()
+            self.runtime = None
+            self.model_loaded = False
+
+    def extract_text(self, image_path: ImageSource, language: str = "eng") -> Dict[str, Any]:
+        """
+        Extract text from one image
+
+        Args:
+            image_path: Path to image file, raw image bytes, PIL image or decoded array
+            language: Language hint
+
+        Returns:
+            Dictionary with extracted text and metadata
+        """
+        return self.extract_text_batch([image_path], language)[0]
+
+    def extract_text_batch(self, image_paths: List[ImageSource], language: str = "eng") -> List[Dict[str, Any]]:
+        """
+        Extract text from several images; the runtime batches them continuously.
+
+        Returns one result dict per input, in input order.
+        """
+        start_time = time.time()
+        if not self.load_model():
+            return [self._create_error_response("SGLang runtime not available", start_time) for _ in image_paths]
+
+        results: List[Optional[Dict[str, Any]]] = [None] * len(image_paths)
+        prompt = self._create_ocr_prompt(language)
+        batch_indices, arguments = [], []
+        for index, image_path in enumerate(image_paths):
+            try:
+                # sgl.image takes a file path or encoded bytes
+                image = image_path if isinstance(image_path, str) else encode_image_bytes(image_path)
+            except Exception as e:
+                results[index] = self._create_error_response(f"Failed to read image: {e}", start_time)
+                continue
+            batch_indices.append(index)
+            arguments.append({"image": image, "prompt": prompt, "max_tokens": self.max_tokens})
+
+        if arguments:
+            logger.info(f"🎯 Sending {len(arguments)} images to SGLang")
+            try:
+                states = ocr_program.run_batch(arguments, backend=self.runtime, progress_bar=False)
+            except Exception as e:
+                logger.error(f"❌ SGLang batch failed: {e}")
+                states = [None] * len(arguments)
+                for index in batch_indices:
+                    results[index] = self._create_error_response(str(e), start_time)
+
+            for index, state in zip(batch_indices, states):
+                if state is None:
+                    continue
+                try:
+                    extracted_text = state["answer"].strip()
+                except Exception as e:
+                    logger.error(f"❌ SGLang request failed for {describe_source(image_paths[index])}: {e}")
+                    results[index] = self._create_error_response(str(e), start_time)
+                    continue
+                results[index] = self._create_success_response(extracted_text, language, start_time)
+
+        logger.info(f"✅ SGLang OCR of {len(image_paths)} images completed in {time.time() - start_time:.2f}s")
+        return results
+
+    def _create_ocr_prompt(self, language: str) -> str:
+        """Create an appropriate OCR prompt."""
+        if language in ["urd", "ara"]:
+            return "What is the text written in this image? Please transcribe all text accurately, including any Arabic or Urdu text."
+        else:
+            return "What is the text written in this image? Please transcribe all text accurately."
+
+    def _create_success_response(self, extracted_text: str, language: str, start_time: float) -> Dict[str, Any]:
+        """Create a standardized success response."""
+        return {
+            "text": extracted_text,
+            "confidence": 90.0,  # High confidence for Qwen
+            "language": language,
+            "engine": "Qwen2.5-VL-3B-Instruct (SGLang)",
+            "word_count": len(extracted_text.split()) if extracted_text else 0,
+            "processing_time": time.time() - start_time,
+            "model_name": self.model_name,
+            "device": self.device,
+            "success": True
+        }
+
+    def _create_error_response(self, error_message: str, start_time: float) -> Dict[str, Any]:
+        """Create a standardized error response."""
+        return {
+            "text": "",
+            "confidence": 0.0,
+            "language": "unknown",
+            "engine": "Qwen2.5-VL-3B-Instruct (SGLang)",
+            "word_count": 0,
+            "processing_time": time.time() - start_time,
+            "model_name": self.model_name,
+            "device": self.device,
+            "success": False,
+            "error": error_message
+        }
+
+
+# Enabled by setting SGLANG_MODEL_PATH; the runtime starts with the server's model prewarm
+SGLANG_MODEL_PATH = os.getenv("SGLANG_MODEL_PATH")
+
+sglang_qwen_ocr = (
+    SGLangQwenOCR(
+        SGLANG_MODEL_PATH,
+        tp_size=int(os.getenv("SGLANG_TP_SIZE", "1")),
+    )
+    if SGLANG_AVAILABLE and SGLANG_MODEL_PATH else None
+)
@@ -0,0 +1,191 @@
+"""
+Qwen2.5-VL OCR Engine backed by a vLLM server
+Sends images to vLLM's OpenAI-compatible chat endpoint so continuous
+batching and PagedAttention run on the server instead of per-request HF forwards
+"""
+
+import asyncio
+import base64
+import logging
+import os
+import time
+from typing import Dict, Any, Optional
+
+from .image_io import ImageSource, describe_source, encode_image_bytes, sniff_mime
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Check for dependencies
+try:
+    import httpx
+    HTTPX_AVAILABLE = True
+except ImportError:
+    HTTPX_AVAILABLE = False
+    logger.warning("⚠️ httpx not available - vLLM backend disabled")
+
+
+def encode_image_data_url(image_source: ImageSource) -> str:
+    """Encode an OCR input as a base64 data URL for the chat API."""
+    data = encode_image_bytes(image_source)
+    mime = sniff_mime(data[:16]) or "image/png"
+    return f"data:{mime};base64,{base64.b64encode(data).decode('ascii')}"
+
+
+def build_chat_payload(model_name: str, data_url: str, prompt: str, max_tokens: int) -> Dict[str, Any]:
+    """OpenAI-style chat request with one image and one text prompt."""
+    return {
+        "model": model_name,
+        "messages": [{
+            "role": "user",
+            "content": [
+                {"type": "image_url", "image_url": {"url": data_url}},
+                {"type": "text", "text": prompt},
+            ],
+        }],
+        "max_tokens": max_tokens,
+        "temperature": 0.0,
+    }
+
+
+def parse_chat_response(response_json: Dict[str, Any]) -> str:
+    """Extract the generated text from an OpenAI-style chat response."""
+    return response_json["choices"][0]["message"]["content"].strip()
+
+
+class VLLMQwenOCR:
+    """
+    Qwen2.5-VL OCR Engine that talks to a vLLM server
+    Serve a W8A8 checkpoint (see quantize_qwen_w8a8.py) for int8 Tensor Core throughput
+    """
+
+    def __init__(self, base_url: str, model_name: str = "Qwen/Qwen2.5-VL-3B-Instruct",
+                 timeout: float = 30.0, api_key: Optional[str] = None, max_tokens: int = 512):
+        self.base_url = base_url.rstrip("/")
+        self.model_name = model_name
+        self.timeout = timeout
+        self.api_key = api_key
+        self.max_tokens = max_tokens
+        self.device = "vllm"
+        self._client: Optional["httpx.AsyncClient"] = None
+
+        logger.info(f"🚀 vLLM Qwen OCR Engine initialized")
+        logger.info(f"🌐 Server: {self.base_url}")
+        logger.info(f"🎯 Model: {self.model_name}")
+        logger.info(f"⏰ Timeout: {self.timeout}s")
+
+    @property
+    def client(self) -> "httpx.AsyncClient":
+        """Shared connection pool, created on first use."""
+        if self._client is None:
+            headers = {"Authorization": f"Bearer {self.api_key}"} if self.api_key else None
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers=headers,
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=256, max_keepalive_connections=64)
+            )
+        return self._client
+
+    async def aclose(self):
+        """Close the HTTP connection pool."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def extract_text(self, image_path: ImageSource, language: str = "eng") -> Dict[str, Any]:
+        """
+        Extract text from image through the vLLM server
+
+        Args:
+            image_path: Path to image file, raw image bytes or PIL image
+            language: Language hint
+
+        Returns:
+            Dictionary with extracted text and metadata
+        """
+        start_time = time.time()
+        logger.info(f"📷 Sending image to vLLM: {describe_source(image_path)}")
+
+        try:
+            # Large spooled uploads are read from disk off the event loop
+            data_url = await asyncio.to_thread(encode_image_data_url, image_path)
+        except Exception as e:
+            logger.error(f"❌ Failed to read image: {e}")
+            return self._create_error_response(f"Failed to read image: {e}", start_time)
+
+        payload = build_chat_payload(
+            self.model_name, data_url, self._create_ocr_prompt(language), self.max_tokens
+        )
+
+        try:
+            response = await self.client.post("/v1/chat/completions", json=payload)
+            response.raise_for_status()
+            extracted_text = parse_chat_response(response.json())
+        except httpx.TimeoutException:
+            logger.warning(f"⏰ vLLM request timed out after {self.timeout}s")
+            return self._create_timeout_response(f"vLLM request timed out after {self.timeout}s", start_time)
+        except Exception as e:
+            logger.error(f"❌ vLLM request failed: {e}")
+            return self._create_error_response(str(e), start_time)
+
+        logger.info(f"✅ vLLM extraction completed in {time.time() - start_time:.2f}s")
+        return {
+            "text": extracted_text,
+            "confidence": 90.0,  # High confidence for Qwen
+            "language": language,
+            "engine": "Qwen2.5-VL-3B-Instruct (vLLM)",
+            "word_count": len(extracted_text.split()) if extracted_text else 0,
+            "processing_time": time.time() - start_time,
+            "model_name": self.model_name,
+            "device": self.device,
+            "success": True,
+            "timeout_used": self.timeout
+        }
+
+    def _create_ocr_prompt(self, language: str) -> str:
+        """Create an appropriate OCR prompt."""
+        if language in ["urd", "ara"]:
+            return "What is the text written in this image? Please transcribe all text accurately, including any Arabic or Urdu text."
+        else:
+            return "What is the text written in this image? Please transcribe all text accurately."
+
+    def _create_error_response(self, error_message: str, start_time: float) -> Dict[str, Any]:
+        """Create a standardized error response."""
+        return {
+            "text": "",
+            "confidence": 0.0,
+            "language": "unknown",
+            "engine": "Qwen2.5-VL-3B-Instruct (vLLM)",
+            "word_count": 0,
+            "processing_time": time.time() - start_time,
+            "model_name": self.model_name,
+            "device": self.device,
+            "success": False,
+            "error": error_message,
+            "timeout_used": self.timeout
+        }
+
+    def _create_timeout_response(self, error_message: str, start_time: float) -> Dict[str, Any]:
+        """Create a timeout-specific response."""
+        response = self._create_error_response(error_message, start_time)
+        response["engine"] = "Qwen2.5-VL-3B-Instruct (Timeout)"
+        response["timeout_occurred"] = True
+        response["fallback_recommended"] = True
+        return response
+
+
+# Enabled by pointing VLLM_BASE_URL at a running `vllm serve` instance
+VLLM_BASE_URL = os.getenv("VLLM_BASE_URL")
+VLLM_MODEL = os.getenv("VLLM_MODEL", "Qwen/Qwen2.5-VL-3B-Instruct")
+
+vllm_qwen_ocr = (
+    VLLMQwenOCR(
+        VLLM_BASE_URL,
+        model_name=VLLM_MODEL,
+        timeout=float(os.getenv("VLLM_TIMEOUT", "30")),
+        api_key=os.getenv("VLLM_API_KEY"),
+    )
+    if HTTPX_AVAILABLE and VLLM_BASE_URL else None
+)
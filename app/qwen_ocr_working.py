@@ -4,19 +4,36 @@ Uses the approach that actually works without hanging
 """
 
 import logging
+import os
 import time
-import threading
 from pathlib import Path
-from typing import Dict, Any, Optional, Callable
+from typing import Dict, Any, Optional, Callable, Union
+
+from .generation import (
+    BITSANDBYTES_AVAILABLE, CPU_QUANTIZATIONS, DeadlineStoppingCriteria, StopOnRepeat, accelerator_dtype,
+    compile_forward, compile_setting, cpu_torch_dtype, default_cpu_quantization, nf4_load_kwargs,
+    optimize_for_cpu, pick_device, probe_mps
+)
+from .image_io import blank_page, decode_image, open_image
+from .qwen_inputs import SUPPORTED_LANGUAGES, PromptTokenCache, VisionEmbeddingCache
+from .result_cache import content_hash
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Longest image side fed to the model (from working example)
+WORKING_MAX_SIDE = 1260
+
+# Generation cap; small crops get a smaller one (about 3 characters per token)
+WORKING_MAX_NEW_TOKENS = 128
+PIXELS_PER_CHAR = 200
+SMALL_IMAGE_MAX_NEW_TOKENS = 16
+
 # Check for dependencies
 try:
     import torch
-    from transformers import AutoTokenizer, AutoProcessor, AutoModelForVision2Seq
+    from transformers import AutoTokenizer, AutoProcessor, AutoModelForVision2Seq, StoppingCriteriaList
     from PIL import Image
     import transformers
 
@@ -63,7 +80,9 @@ class WorkingQwenOCR:
     Uses the approach that actually works without hanging on M1 Pro
     """
     
-    def __init__(self, model_name: str = "Qwen/Qwen2.5-VL-3B-Instruct", timeout: int = 600):
+    def __init__(self, model_name: str = "Qwen/Qwen2.5-VL-3B-Instruct", timeout: int = 600,
+                 device: Optional[str] = None, quantization: str = "fp32",
+                 compile_model: Union[bool, str] = False, vision_cache_size: int = 32):
         # Model compatibility fallback list
         self.model_candidates = [
             "Qwen/Qwen2.5-VL-3B-Instruct",  # Preferred (newest)
@@ -85,13 +104,28 @@ class WorkingQwenOCR:
         self.model = None
         self.tokenizer = None
         self.processor = None
+        # Pre-tokenized prompt halves per language (chat-template models only), set at load time
+        self.prompt_tokens: Optional[PromptTokenCache] = None
+        # Vision encoder output per image content, so retries and repeated pages skip the ViT
+        self.vision_cache_size = vision_cache_size
+        self.vision_cache: Optional[VisionEmbeddingCache] = None
         self.model_loaded = False
         self.model_approach = model_approach  # Store the approach being used
 
-        # Use CPU for better compatibility (MPS has Conv3D issues with Qwen)
-        self.device = torch.device("cpu")
-        if torch.backends.mps.is_available():
-            logger.info("🍎 MPS available but using CPU for Qwen compatibility")
+        # CUDA, then MPS, then CPU; if MPS can't run the model (e.g. its Conv3D patch
+        # embedding) the load-time probe moves it to CPU
+        self.device = device or (pick_device() if TRANSFORMERS_AVAILABLE else "cpu")
+        # CPU weight format: "fp32", "bf16" (IPEX on x86 when installed) or "int8" (dynamic quantization)
+        if quantization not in CPU_QUANTIZATIONS:
+            logger.warning(f"⚠️ Unknown quantization {quantization!r}, using fp32")
+            quantization = "fp32"
+        self.quantization = quantization
+        self.compile_model = compile_model  # torch.compile forward + warm-up at load time
+        # Half precision on accelerators; bf16 weights (never emulated fp16) or fp32 on CPU
+        self.torch_dtype = (
+            (accelerator_dtype(self.device) if self.device != "cpu" else cpu_torch_dtype(self.quantization))
+            if TRANSFORMERS_AVAILABLE else None
+        )
 
         logger.info(f"🤖 Working Qwen OCR Engine initialized")
         logger.info(f"📱 Device: {self.device}")
@@ -149,13 +183,29 @@ class WorkingQwenOCR:
             # Try different loading approaches based on environment compatibility
             model_loaded = False
 
-            # Approach 1: Try with device_map="auto" (best performance)
-            if not model_loaded:
+            # Approach 0: NF4 4-bit weights on CUDA (a quarter of the bytes streamed per decoded token)
+            if not model_loaded and self.device == "cuda" and BITSANDBYTES_AVAILABLE:
+                try:
+                    logger.info("🔄 Trying NF4 4-bit weights via bitsandbytes...")
+                    self.model = QwenModel.from_pretrained(
+                        self.actual_model_used,  # Use the compatible model
+                        torch_dtype=self.torch_dtype,
+                        low_cpu_mem_usage=True,
+                        trust_remote_code=True,
+                        **nf4_load_kwargs()
+                    )
+                    logger.info("✅ Model loaded with NF4 4-bit weights")
+                    model_loaded = True
+                except Exception as e:
+                    logger.warning(f"⚠️ NF4 loading failed: {e}")
+
+            # Approach 1: Try with device_map="auto" (best performance; spreads over CUDA GPUs)
+            if not model_loaded and self.device == "cuda":
                 try:
                     logger.info("🔄 Trying device_map='auto' approach...")
                     self.model = QwenModel.from_pretrained(
                         self.actual_model_used,  # Use the compatible model
-                        torch_dtype=torch.float16,
+                        torch_dtype=self.torch_dtype,
                         device_map="auto",
                         offload_buffers=True,
                         trust_remote_code=True
@@ -168,10 +218,10 @@ class WorkingQwenOCR:
             # Approach 2: Try without device_map (more compatible)
             if not model_loaded:
                 try:
-                    logger.info("🔄 Trying manual device assignment...")
+                    logger.info(f"🔄 Trying manual device assignment ({self.device}, {self.torch_dtype})...")
                     self.model = QwenModel.from_pretrained(
                         self.actual_model_used,  # Use the compatible model
-                        torch_dtype=torch.float16,
+                        torch_dtype=self.torch_dtype,
                         low_cpu_mem_usage=True,
                         trust_remote_code=True
                     ).to(self.device)
@@ -214,6 +264,27 @@ class WorkingQwenOCR:
 
             self.processor = AutoProcessor.from_pretrained(self.actual_model_used)
             logger.info("✅ Processor loaded")
+
+            if getattr(self.processor, "chat_template", None):
+                # Template and tokenize each language's prompt once; requests then only run the image processor
+                prompt_tokens = PromptTokenCache(self.processor, self._create_ocr_prompt)
+                if prompt_tokens.warm(SUPPORTED_LANGUAGES, open_image(blank_page(64))):
+                    self.prompt_tokens = prompt_tokens
+
+            # One-token generate on MPS; ops it can't run send the model to CPU now, not on a request
+            self.model, self.device = probe_mps(self.model, self.device, self._probe)
+
+            if self.device == "cpu" and self.quantization != "fp32":
+                self.model = optimize_for_cpu(self.model, self.quantization)
+
+            vision_cache = VisionEmbeddingCache(self.model, self.vision_cache_size)
+            if vision_cache.supported:
+                self.vision_cache = vision_cache
+                logger.info(f"🧠 Caching vision encoder output for {self.vision_cache_size} images")
+
+            if self.compile_model and hasattr(torch, "compile"):
+                compile_forward(self.model, self.device, self.compile_model)
+                self._warm_up()
             
             if progress_callback:
                 progress_callback("Model ready for inference", 100)
@@ -225,52 +296,98 @@ class WorkingQwenOCR:
             logger.error(f"❌ Failed to load model: {e}")
             return False
     
-    def resize_image(self, image: Image.Image, max_height: int = 1260, max_width: int = 1260) -> Image.Image:
-        """Resize image if it exceeds specified dimensions (from working example)."""
-        original_width, original_height = image.size
-        
-        # Check if resizing is needed
-        if original_width > max_width or original_height > max_height:
-            # Calculate the new size maintaining the aspect ratio
-            aspect_ratio = original_width / original_height
-            if original_width > original_height:
-                new_width = max_width
-                new_height = int(max_width / aspect_ratio)
-            else:
-                new_height = max_height
-                new_width = int(max_height * aspect_ratio)
-            
-            # Resize the image using LANCZOS for high-quality downscaling
-            return image.resize((new_width, new_height), Image.LANCZOS)
-        else:
-            return image
-    
+    def _probe(self):
+        """One-token generate() on a blank page, used to verify the device at load time."""
+        inputs = self._build_inputs(open_image(blank_page(64)), "eng")
+        self.model.generate(**inputs, max_new_tokens=1, do_sample=False)
+
+    def _warm_up(self):
+        """Run one short generate() so compilation happens before the first request."""
+        logger.info("🔥 Warming up compiled model (one-time compile)...")
+        start_time = time.time()
+        try:
+            inputs = self._build_inputs(open_image(blank_page(512)), "eng")
+            with torch.inference_mode():
+                self.model.generate(**inputs, max_new_tokens=4, do_sample=False)
+        except Exception as e:
+            # Fall back to the eager forward rather than failing the load
+            logger.warning(f"⚠️ Compiled warm-up failed ({e}), using eager forward")
+            del self.model.forward
+            return
+        logger.info(f"✅ Warm-up finished in {time.time() - start_time:.1f}s")
+
+    def _build_inputs(self, img: "Image.Image", language: str):
+        """Model inputs for one image, from the cached prompt tokens when the template allows it."""
+        if self.prompt_tokens is not None:
+            # Cached prompt ids with the image-pad run spliced in; no templating or tokenizing
+            return self.prompt_tokens.build([img], language).to(self.device)
+
+        # Create OCR prompt
+        prompt = self._create_ocr_prompt(language)
+
+        # Use the working message format
+        messages = [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "image", "image": img},
+                    {"type": "text", "text": prompt}
+                ]
+            }
+        ]
+
+        # Apply chat template (working approach)
+        text = self.processor.apply_chat_template(
+            messages, tokenize=False, add_generation_prompt=True
+        )
+
+        # Process inputs (working approach)
+        return self.processor(
+            text=[text],
+            images=[img],
+            padding=True,
+            return_tensors="pt"
+        ).to(self.device)
+
+    def _encode_vision(self, inputs, img: "Image.Image"):
+        """
+        Swap pixel_values for the image's cached (or freshly computed) vision
+        embeddings, keyed by its resized pixel content, so generate() only runs
+        the language model.
+        """
+        if self.vision_cache is None:
+            return inputs
+        try:
+            with torch.inference_mode():
+                return self.vision_cache.embed(inputs, [(content_hash(img.tobytes()), img.size)])
+        except Exception as e:
+            logger.warning(f"⚠️ Vision embedding cache disabled ({e}), passing pixel values to generate()")
+            self.vision_cache = None
+            return inputs
+
+    def _max_new_tokens(self, img: "Image.Image") -> int:
+        """Token cap from the image area: a small crop cannot hold a page of text."""
+        width, height = img.size
+        estimated_chars = width * height // PIXELS_PER_CHAR
+        return max(SMALL_IMAGE_MAX_NEW_TOKENS, min(WORKING_MAX_NEW_TOKENS, estimated_chars // 3))
+
     def _generate_with_timeout(self, inputs, generation_kwargs):
-        """Generate text with timeout handling."""
-        result = {"success": False, "output": None, "error": None}
-        
-        def target():
-            try:
-                # Use the working generation approach
-                outputs = self.model.generate(**inputs, **generation_kwargs)
-                result["output"] = outputs
-                result["success"] = True
-            except Exception as e:
-                result["error"] = str(e)
-        
-        # Start generation in a separate thread
-        thread = threading.Thread(target=target)
-        thread.daemon = True
-        thread.start()
-        
-        # Wait for completion or timeout
-        thread.join(timeout=self.timeout)
-        
-        if thread.is_alive():
-            logger.warning(f"⏰ Text generation timed out after {self.timeout}s")
-            result["error"] = f"Text generation timed out after {self.timeout}s"
-            result["success"] = False
-        
+        """Generate text on the calling thread, stopping cleanly once the time budget is spent."""
+        result = {"success": False, "output": None, "error": None, "timed_out": False}
+        deadline = DeadlineStoppingCriteria(self.timeout)
+        stopping_criteria = StoppingCriteriaList([deadline, StopOnRepeat(inputs["input_ids"].shape[1])])
+        try:
+            with torch.inference_mode():
+                result["output"] = self.model.generate(
+                    **inputs, **generation_kwargs, stopping_criteria=stopping_criteria
+                )
+            result["success"] = True
+        except Exception as e:
+            result["error"] = str(e)
+
+        if deadline.expired:
+            logger.warning(f"⏰ Text generation stopped at the {self.timeout}s budget")
+            result["timed_out"] = True
         return result
     
     def extract_text(self, image_path: str, language: str = "eng", 
@@ -297,38 +414,12 @@ class WorkingQwenOCR:
             
             # Load and resize image (from working example)
             try:
-                with Image.open(image_path) as img:
-                    # Resize image to reduce memory pressure
-                    img = self.resize_image(img, max_height=1260, max_width=1260)
-                    logger.info(f"✅ Image loaded and resized: {img.size}")
-                    
-                    # Create OCR prompt
-                    prompt = self._create_ocr_prompt(language)
-                    
-                    # Use the working message format
-                    messages = [
-                        {
-                            "role": "user", 
-                            "content": [
-                                {"type": "image", "image": img}, 
-                                {"type": "text", "text": prompt}
-                            ]
-                        }
-                    ]
-                    
-                    # Apply chat template (working approach)
-                    text = self.processor.apply_chat_template(
-                        messages, tokenize=False, add_generation_prompt=True
-                    )
-                    
-                    # Process inputs (working approach)
-                    inputs = self.processor(
-                        text=[text], 
-                        images=[img], 
-                        padding=True, 
-                        return_tensors="pt"
-                    ).to(self.device)
-                    
+                # Decode straight to at most 1260px (libvips thumbnail or JPEG draft) in one pass
+                img = open_image(decode_image(image_path, WORKING_MAX_SIDE))
+                logger.info(f"✅ Image loaded and resized: {img.size}")
+
+                inputs = self._encode_vision(self._build_inputs(img, language), img)
+
             except Exception as e:
                 return self._create_error_response(f"Failed to process image: {e}", start_time)
             
@@ -338,11 +429,13 @@ class WorkingQwenOCR:
             # Generate with working parameters
             logger.info(f"🎯 Generating text (timeout: {self.timeout}s)...")
             
+            # Greedy decoding: OCR is transcription, and sampling only adds per-step work
             generation_kwargs = {
-                "max_new_tokens": 128,      # More conservative for CPU
-                "temperature": 0.3,         # Lower temperature for more focused output
+                "max_new_tokens": self._max_new_tokens(img),
+                "min_new_tokens": 1,
+                "do_sample": False,
+                "num_beams": 1,
                 "repetition_penalty": 1.1,  # From working example
-                "do_sample": True,          # Enable sampling
                 "pad_token_id": self.tokenizer.eos_token_id,
                 "eos_token_id": self.tokenizer.eos_token_id,
                 "use_cache": True,          # Enable caching for speed
@@ -355,14 +448,13 @@ class WorkingQwenOCR:
                 logger.error(f"❌ Generation failed: {error_msg}")
                 return self._create_timeout_response(error_msg, start_time)
             
-            # Decode output using working approach
+            # Decode only the generated tokens; the prompt is never decoded or searched
             logger.info("📝 Decoding output...")
             outputs = generation_result["output"]
-            response_ids = outputs[0]
-            response_text = self.tokenizer.decode(response_ids, skip_special_tokens=False)
-            
-            # Extract the actual response (from working example)
-            extracted_text = self._extract_response_text(response_text)
+            response_ids = outputs[0, inputs["input_ids"].shape[1]:].cpu()
+            extracted_text = self.tokenizer.decode(
+                response_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False
+            ).strip()
             
             processing_time = time.time() - start_time
             
@@ -383,6 +475,7 @@ class WorkingQwenOCR:
                 "device": str(self.device),
                 "success": True,
                 "timeout_used": self.timeout,
+                "timeout_occurred": generation_result["timed_out"],
                 "approach": "working_mac_solution"
             }
             
@@ -397,16 +490,6 @@ class WorkingQwenOCR:
         else:
             return "Extract and transcribe all text from this image exactly as it appears. Provide only the text content without description."
     
-    def _extract_response_text(self, full_response: str) -> str:
-        """Extract the actual response text (from working example)."""
-        try:
-            # Use the working extraction method
-            response = full_response.split('<|im_start|>assistant')[-1].split('<|im_end|>')[0].strip()
-            return response
-        except Exception as e:
-            logger.warning(f"⚠️ Text extraction failed: {e}")
-            return full_response.strip()
-    
     def _create_error_response(self, error_message: str, start_time: float) -> Dict[str, Any]:
         """Create a standardized error response."""
         return {
@@ -444,4 +527,9 @@ class WorkingQwenOCR:
         }
 
 # Create global instance
-working_qwen_ocr = WorkingQwenOCR() if TRANSFORMERS_AVAILABLE else None
+working_qwen_ocr = WorkingQwenOCR(
+    device=os.getenv("QWEN_DEVICE") or None,
+    quantization=os.getenv("QWEN_CPU_QUANTIZATION") or default_cpu_quantization(),
+    compile_model=compile_setting(os.getenv("QWEN_TORCH_COMPILE", "0")),
+    vision_cache_size=int(os.getenv("QWEN_VISION_CACHE_SIZE", "32"))
+) if TRANSFORMERS_AVAILABLE else None
@@ -0,0 +1,143 @@
+"""In-process cache of OCR results keyed by uploaded image content."""
+
+import asyncio
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from typing import Any, Hashable, Iterable, Optional
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# xxh3 hashes several GB/s; fall back to hashlib when it is not installed
+try:
+    import xxhash
+    XXHASH_AVAILABLE = True
+except ImportError:
+    XXHASH_AVAILABLE = False
+    logger.info("xxhash not available - using blake2b for upload hashing")
+
+# Optional persistent second tier that survives restarts
+try:
+    import diskcache
+    DISKCACHE_AVAILABLE = True
+except ImportError:
+    DISKCACHE_AVAILABLE = False
+
+
+def new_hasher():
+    """Create an incremental hasher (supports update() and hexdigest())."""
+    if XXHASH_AVAILABLE:
+        return xxhash.xxh3_64()
+    return hashlib.blake2b(digest_size=16)
+
+
+def content_hash(data: bytes) -> str:
+    """Hash a complete upload."""
+    hasher = new_hasher()
+    hasher.update(data)
+    return hasher.hexdigest()
+
+
+def config_fingerprint(env_prefixes: Iterable[str], version: str = "") -> str:
+    """
+    Hash of every environment variable starting with one of env_prefixes (plus
+    a version string), so cached results from another engine setup never match.
+    """
+    prefixes = tuple(env_prefixes)
+    hasher = new_hasher()
+    hasher.update(version.encode())
+    for name in sorted(os.environ):
+        if name.startswith(prefixes):
+            hasher.update(f"\0{name}={os.environ[name]}".encode())
+    return hasher.hexdigest()
+
+
+class ResultCache:
+    """
+    Least-recently-used cache of OCR responses.
+
+    An in-memory LRU sits in front of an optional on-disk diskcache tier;
+    disk hits are promoted back into memory. Values must be picklable when
+    the disk tier is enabled. From async code use aget()/aput(), which keep
+    the disk tier's SQLite I/O off the event loop.
+    """
+
+    def __init__(self, maxsize: int = 1024, disk_dir: Optional[str] = None,
+                 disk_size_limit: int = 1024 ** 3):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        self._disk = None
+        if disk_dir:
+            if DISKCACHE_AVAILABLE:
+                self._disk = diskcache.Cache(disk_dir, size_limit=disk_size_limit)
+                logger.info(f"Persistent result cache at {disk_dir}")
+            else:
+                logger.info("diskcache not available - result cache is memory-only")
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return the cached value for key, or None."""
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+        if self._disk is not None:
+            value = self._disk.get(key)
+            if value is not None:
+                self._remember(key, value)
+                self.hits += 1
+                return value
+
+        self.misses += 1
+        return None
+
+    def put(self, key: Hashable, value: Any):
+        """Store a value in memory (and on disk), evicting the least recently used entry when full."""
+        self._remember(key, value)
+        if self._disk is not None:
+            self._disk.set(key, value)
+
+    async def aget(self, key: Hashable) -> Optional[Any]:
+        """get() for the event loop: the memory tier inline, the disk tier in a thread."""
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+        if self._disk is not None:
+            value = await asyncio.to_thread(self._disk.get, key)
+            if value is not None:
+                self._remember(key, value)
+                self.hits += 1
+                return value
+
+        self.misses += 1
+        return None
+
+    async def aput(self, key: Hashable, value: Any):
+        """put() for the event loop: the memory tier inline, the disk write in a thread."""
+        self._remember(key, value)
+        if self._disk is not None:
+            await asyncio.to_thread(self._disk.set, key, value)
+
+    def _remember(self, key: Hashable, value: Any):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def close(self):
+        """Close the disk tier, if any."""
+        if self._disk is not None:
+            self._disk.close()
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,16 @@
+"""Cheap statistics of OCR output text, used by the engines' confidence heuristics."""
+
+import numpy as np
+
+# ASCII lookup: True for characters that are neither alphanumeric nor whitespace
+_ASCII_SPECIAL = np.array([not chr(i).isalnum() and not chr(i).isspace() for i in range(128)])
+# Deletes ASCII alphanumerics and whitespace, leaving only characters that need a Unicode check
+_ASCII_PLAIN_DELETE = str.maketrans("", "", "".join(chr(i) for i in range(128) if not _ASCII_SPECIAL[i]))
+
+
+def count_special_chars(text: str) -> int:
+    """Count characters that are neither alphanumeric nor whitespace."""
+    if text.isascii():
+        return int(np.count_nonzero(_ASCII_SPECIAL[np.frombuffer(text.encode("ascii"), dtype=np.uint8)]))
+    remaining = text.translate(_ASCII_PLAIN_DELETE)
+    return sum(1 for c in remaining if not c.isalnum() and not c.isspace())
@@ -1,10 +1,14 @@
 """TrOCR OCR Engine as a fallback for Qwen2.5-VL."""
 
 import logging
+import os
 from PIL import Image
-from typing import Dict, Any
+from typing import Dict, Any, Union
 import time
 
+from .generation import compile_forward, compile_setting
+from .text_metrics import count_special_chars
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -22,11 +26,12 @@ except ImportError as e:
 class TrOCREngine:
     """OCR engine using TrOCR model."""
     
-    def __init__(self, model_name: str = "microsoft/trocr-base-printed"):
+    def __init__(self, model_name: str = "microsoft/trocr-base-printed", compile_model: Union[bool, str] = False):
         self.model_name = model_name
         self.model = None
         self.processor = None
         self.device = "cpu"
+        self.compile_model = compile_model  # torch.compile forward + warm-up at load time
         self.model_loaded = False
         logger.info(f"TrOCR Engine initialized. Device: {self.device}")
         logger.info(f"Model will be loaded on first use: {self.model_name}")
@@ -46,10 +51,14 @@ class TrOCREngine:
             
             # Load processor and model
             self.processor = TrOCRProcessor.from_pretrained(self.model_name)
-            self.model = VisionEncoderDecoderModel.from_pretrained(self.model_name)
+            self.model = VisionEncoderDecoderModel.from_pretrained(self.model_name, low_cpu_mem_usage=True)
             
             # Move to device
             self.model = self.model.to(self.device)
+
+            if self.compile_model and hasattr(torch, "compile"):
+                compile_forward(self.model, self.device, self.compile_model)
+                self._warm_up()
             
             self.model_loaded = True
             logger.info("TrOCR model loaded successfully!")
@@ -59,6 +68,18 @@ class TrOCREngine:
             logger.error(f"Failed to load TrOCR model: {e}")
             return False
     
+    def _warm_up(self):
+        """Run one generate() on a blank line image so compilation happens before the first request."""
+        logger.info("Warming up compiled TrOCR model...")
+        try:
+            pixel_values = self.processor(Image.new("RGB", (384, 64), "white"), return_tensors="pt").pixel_values
+            with torch.inference_mode():
+                self.model.generate(pixel_values.to(self.device), max_new_tokens=4)
+        except Exception as e:
+            # Fall back to the eager forward rather than failing the load
+            logger.warning(f"Compiled TrOCR warm-up failed ({e}), using eager forward")
+            del self.model.forward
+
     def is_available(self) -> bool:
         """Check if the model is loaded and available."""
         return self.model_loaded and self.model is not None and self.processor is not None
@@ -93,7 +114,7 @@ class TrOCREngine:
             pixel_values = pixel_values.to(self.device)
             
             # Generate text
-            with torch.no_grad():
+            with torch.inference_mode():
                 generated_ids = self.model.generate(pixel_values)
             
             # Decode text
@@ -145,7 +166,7 @@ class TrOCREngine:
             base_confidence -= 20.0
         
         # Reduce confidence for text with many special characters
-        special_char_ratio = sum(1 for c in text if not c.isalnum() and not c.isspace()) / len(text)
+        special_char_ratio = count_special_chars(text) / len(text)
         if special_char_ratio > 0.3:
             base_confidence -= 15.0
         
@@ -184,4 +205,4 @@ class TrOCREngine:
         }
 
 # Global instance
-trocr_ocr = TrOCREngine()
+trocr_ocr = TrOCREngine(compile_model=compile_setting(os.getenv("TROCR_TORCH_COMPILE", "0")))
@@ -0,0 +1,30 @@
+"""
+Gunicorn settings for several uvicorn workers sharing one copy of Qwen2.5-VL.
+
+    pip install gunicorn
+    gunicorn -c gunicorn.conf.py app.main:app
+
+On CPU the app is imported and the model loaded once in the master process;
+its weights are moved into shared memory before the workers fork, so every
+worker maps the same pages instead of loading its own copy. On CUDA/MPS
+nothing is preloaded: a GPU context created in the master does not survive
+the fork, so each worker loads its own model.
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '3030')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+timeout = 300  # First model download can be slow
+
+
+def on_starting(server):
+    """Load Qwen in the master (before any worker forks) and share its weights, CPU only."""
+    from app.qwen_ocr_robust import robust_qwen_ocr
+
+    if robust_qwen_ocr is None or robust_qwen_ocr.device != "cpu":
+        return
+    if robust_qwen_ocr.load_model():
+        robust_qwen_ocr.share_memory()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Quantize Qwen2.5-VL to W8A8 (int8 weights and activations) for vLLM.
+
+The vision tower and lm_head stay in full precision; only the language
+model's Linear layers are quantized, using SmoothQuant + GPTQ from
+llm-compressor on a small calibration set.
+
+Usage:
+    pip install llmcompressor
+    python quantize_qwen_w8a8.py --output Qwen2.5-VL-3B-Instruct-W8A8
+
+Serve the result with:
+    vllm serve Qwen2.5-VL-3B-Instruct-W8A8 --quantization compressed-tensors \\
+        --max-num-seqs 256 --max-num-batched-tokens 16384 --gpu-memory-utilization 0.7
+"""
+
+import argparse
+import logging
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def quantize(model_id: str, output_dir: str, dataset: str, num_samples: int, max_seq_len: int):
+    """Run one-shot W8A8 quantization and save a compressed-tensors checkpoint."""
+    import torch
+    from transformers import AutoProcessor, Qwen2_5_VLForConditionalGeneration
+    from llmcompressor import oneshot
+    from llmcompressor.modifiers.quantization import GPTQModifier
+    from llmcompressor.modifiers.smoothquant import SmoothQuantModifier
+
+    logger.info(f"📥 Loading {model_id}")
+    model = Qwen2_5_VLForConditionalGeneration.from_pretrained(model_id, torch_dtype="auto")
+    processor = AutoProcessor.from_pretrained(model_id, trust_remote_code=True)
+
+    recipe = [
+        SmoothQuantModifier(smoothing_strength=0.8),
+        GPTQModifier(
+            targets="Linear",
+            scheme="W8A8",
+            sequential_targets=["Qwen2_5_VLDecoderLayer"],
+            ignore=["lm_head", "re:visual.*"],
+        ),
+    ]
+
+    def collate(batch):
+        # One image-text pair at a time
+        return {key: torch.tensor(value) for key, value in batch[0].items()}
+
+    logger.info(f"⚙️ Calibrating on {num_samples} samples from {dataset}")
+    oneshot(
+        model=model,
+        processor=processor,
+        dataset=dataset,
+        recipe=recipe,
+        max_seq_length=max_seq_len,
+        num_calibration_samples=num_samples,
+        data_collator=collate,
+        trust_remote_code_model=True,
+        output_dir=output_dir,
+    )
+    logger.info(f"✅ Saved W8A8 checkpoint to {output_dir}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantize Qwen2.5-VL to W8A8 for vLLM")
+    parser.add_argument("--model", default="Qwen/Qwen2.5-VL-3B-Instruct")
+    parser.add_argument("--output", default="Qwen2.5-VL-3B-Instruct-W8A8")
+    parser.add_argument("--dataset", default="flickr30k")
+    parser.add_argument("--num-samples", type=int, default=256)
+    parser.add_argument("--max-seq-len", type=int, default=2048)
+    args = parser.parse_args()
+
+    quantize(args.model, args.output, args.dataset, args.num_samples, args.max_seq_len)
+
+
+if __name__ == "__main__":
+    main()
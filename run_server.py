@@ -4,6 +4,11 @@
 import uvicorn
 import sys
 import os
+import importlib.util
+
+# C event loop and HTTP parser (both ship with uvicorn[standard])
+LOOP = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+HTTP = "httptools" if importlib.util.find_spec("httptools") else "h11"
 
 # Add the app directory to Python path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -30,6 +35,7 @@ if __name__ == "__main__":
         print(f"🌐 Environment: {environment}")
         print(f"🔧 Port: {port}")
         print(f"🔄 Reload: {reload}")
+        print(f"⚡ Event loop: {LOOP}, HTTP parser: {HTTP}")
         print(f"✅ Server starting at http://0.0.0.0:{port}")
         print(f"📚 API docs available at http://0.0.0.0:{port}/docs")
         print(f"🌐 Web interface at http://0.0.0.0:{port}")
@@ -45,6 +51,11 @@ if __name__ == "__main__":
             reload=False,  # Force disable reload in production
             log_level="info",
             workers=1,  # Single worker for model consistency
+            lifespan="on",  # Startup hook prewarms the models
+            loop=LOOP,
+            http=HTTP,
+            ws_ping_interval=20.0,  # Server->client WebSocket pings
+            ws_ping_timeout=10.0,  # Drop clients that miss a pong
             timeout_keep_alive=60,  # Longer keep alive
             access_log=False,  # Disable access logs to reduce noise
             server_header=False,  # Disable server header
@@ -9,12 +9,14 @@ import time
 from pathlib import Path
 import websocket
 import threading
+import uuid
 
 BASE_URL = "http://localhost:8001"
-WS_URL = "ws://localhost:8001/ws"
+WS_URL = "ws://localhost:8001/ws/{request_id}"
 
 class ProgressTracker:
-    def __init__(self):
+    def __init__(self, request_id):
+        self.request_id = request_id
         self.progress_updates = []
         self.ws = None
         self.connected = False
@@ -48,7 +50,7 @@ class ProgressTracker:
         """Connect to WebSocket."""
         try:
             self.ws = websocket.WebSocketApp(
-                WS_URL,
+                WS_URL.format(request_id=self.request_id),
                 on_message=self.on_message,
                 on_open=self.on_open,
                 on_close=self.on_close,
@@ -73,7 +75,8 @@ def test_progress_tracking():
     print("=" * 60)
     
     # Initialize progress tracker
-    tracker = ProgressTracker()
+    request_id = str(uuid.uuid4())
+    tracker = ProgressTracker(request_id)
     
     # Connect to WebSocket
     print("🔗 Connecting to WebSocket for progress updates...")
@@ -112,7 +115,7 @@ def test_progress_tracking():
     try:
         with open(test_file, 'rb') as f:
             files = {'file': (test_file, f, 'image/webp' if test_file.endswith('.webp') else 'image/jpeg')}
-            data = {'language': 'eng' if 'english' in test_file else 'urd'}
+            data = {'language': 'eng' if 'english' in test_file else 'urd', 'request_id': request_id}
             
             start_time = time.time()
             print(f"🚀 Starting OCR request...")